@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""Bagging over one shared copy of the training data
+
+`BaggingClassifier(DecisionTreeClassifier(), n_estimators=100,
+max_samples=0.8)` copies the sampled rows for every estimator.  Here every
+estimator is trained on the *same* array instead:
+
+* `X` is copied once into a `multiprocessing.shared_memory` block which the
+  worker processes attach to by name; it is stored as float32, the dtype
+  sklearn's trees work in, so that no worker converts (copies) it again,
+* a bootstrap sample is never materialized; it is an index array drawn from
+  a per-estimator seed, turned into per-row counts and passed to the tree as
+  `sample_weight` (which is equivalent for trees to fitting on the repeated
+  rows),
+* only the seeds are kept, so the out-of-bag rows of any estimator can be
+  regenerated, and out-of-bag votes are summed inside each worker.
+
+Memory for the data and the out-of-bag bookkeeping therefore stays at
+O(n_samples) no matter how many estimators are trained.
+
+    bag = SharedBaggingClassifier(DecisionTreeClassifier(), n_estimators=100,
+                                  max_samples=0.8, oob_score=True, n_jobs=4)
+    bag.fit(X, y)
+    bag.oob_score_
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from joblib import effective_n_jobs
+from sklearn.base import BaseEstimator, ClassifierMixin, clone
+from sklearn.utils.validation import has_fit_parameter
+
+MAX_INT = np.iinfo(np.int32).max
+# the dtype sklearn's trees convert X to (``sklearn.tree._tree.DTYPE``,
+# which is only visible to Cython)
+DTYPE = np.float32
+
+
+def bootstrap_indices(seed, n_samples, n_draws, bootstrap=True):
+    """Row indices of one bootstrap sample, regenerated from its seed"""
+    rng = np.random.RandomState(seed)
+    if bootstrap:
+        return rng.randint(0, n_samples, n_draws)
+    return rng.permutation(n_samples)[:n_draws]
+
+
+def _fit_batch(estimator, seeds, X, y_enc, n_classes, n_draws, bootstrap,
+               oob):
+    n_samples = len(X)
+    trees = []
+    oob_votes = np.zeros((n_samples, n_classes)) if oob else None
+    for seed in seeds:
+        idx = bootstrap_indices(seed, n_samples, n_draws, bootstrap)
+        weight = np.bincount(idx, minlength=n_samples).astype(float)
+        tree = clone(estimator).set_params(random_state=seed)
+        tree.fit(X, y_enc, sample_weight=weight)
+        trees.append(tree)
+        if oob:
+            mask = weight == 0
+            if mask.any():
+                oob_votes[mask] += tree.predict_proba(X[mask])
+    return trees, oob_votes
+
+
+def _fit_batch_shared(shm_name, shape, dtype, *args):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        X = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        return _fit_batch(args[0], args[1], X, *args[2:])
+    finally:
+        shm.close()
+
+
+class SharedBaggingClassifier(BaseEstimator, ClassifierMixin):
+    """Bagged classifier trained on a single shared copy of X"""
+
+    def __init__(self, estimator=None, n_estimators=10, max_samples=1.0,
+                 bootstrap=True, oob_score=False, n_jobs=1,
+                 random_state=None):
+        self.estimator = estimator
+        self.n_estimators = n_estimators
+        self.max_samples = max_samples
+        self.bootstrap = bootstrap
+        self.oob_score = oob_score
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+
+    def _n_draws(self, n_samples):
+        if isinstance(self.max_samples, float):
+            return max(1, int(self.max_samples * n_samples))
+        return int(self.max_samples)
+
+    def fit(self, X, y):
+        estimator = self.estimator
+        if estimator is None:
+            from sklearn.tree import DecisionTreeClassifier
+            estimator = DecisionTreeClassifier()
+        if 'random_state' not in estimator.get_params():
+            raise ValueError('%s has no random_state parameter'
+                             % type(estimator).__name__)
+        if not has_fit_parameter(estimator, 'sample_weight'):
+            raise ValueError('%s.fit does not support sample_weight, which '
+                             'bootstrap samples are passed as'
+                             % type(estimator).__name__)
+
+        X = np.ascontiguousarray(X, dtype=DTYPE)
+        self.classes_, y_enc = np.unique(y, return_inverse=True)
+        n_classes = len(self.classes_)
+        n_draws = self._n_draws(len(X))
+
+        rng = np.random.RandomState(self.random_state)
+        self.seeds_ = rng.randint(MAX_INT, size=self.n_estimators)
+        args = (y_enc, n_classes, n_draws, self.bootstrap, self.oob_score)
+
+        n_jobs = min(effective_n_jobs(self.n_jobs), self.n_estimators)
+        if n_jobs == 1:
+            results = [_fit_batch(estimator, self.seeds_, X, *args)]
+        else:
+            batches = np.array_split(self.seeds_, n_jobs)
+            shm = shared_memory.SharedMemory(create=True, size=X.nbytes)
+            try:
+                np.ndarray(X.shape, X.dtype, buffer=shm.buf)[:] = X
+                with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                    futures = [pool.submit(_fit_batch_shared, shm.name,
+                                           X.shape, X.dtype, estimator,
+                                           batch, *args)
+                               for batch in batches if len(batch)]
+                    results = [f.result() for f in futures]
+            finally:
+                shm.close()
+                shm.unlink()
+
+        self.estimators_ = [tree for trees, _ in results for tree in trees]
+
+        if self.oob_score:
+            votes = sum(v for _, v in results)
+            seen = votes.sum(axis=1) > 0
+            self.oob_decision_function_ = np.full(votes.shape, np.nan)
+            self.oob_decision_function_[seen] = (
+                votes[seen] / votes[seen].sum(axis=1, keepdims=True))
+            self.oob_score_ = np.mean(votes[seen].argmax(axis=1)
+                                      == y_enc[seen])
+        return self
+
+    def predict_proba(self, X):
+        X = np.asarray(X, dtype=DTYPE)
+        proba = np.zeros((len(X), len(self.classes_)))
+        for tree in self.estimators_:
+            proba += tree.predict_proba(X)
+        return proba / len(self.estimators_)
+
+    def predict(self, X):
+        return self.classes_[self.predict_proba(X).argmax(axis=1)]
+
+
+if __name__ == '__main__':
+    from time import perf_counter
+    from sklearn.datasets import make_blobs
+    from sklearn.neighbors import KNeighborsClassifier
+    from sklearn.tree import DecisionTreeClassifier
+
+    X, y = make_blobs(n_samples=20000, centers=4, random_state=0,
+                      cluster_std=1.0)
+    for n_jobs in (1, 2, 4):
+        bag = SharedBaggingClassifier(DecisionTreeClassifier(),
+                                      n_estimators=100, max_samples=0.8,
+                                      oob_score=True, n_jobs=n_jobs,
+                                      random_state=1)
+        t0 = perf_counter()
+        bag.fit(X, y)
+        print('n_jobs=%d  %.2fs  oob_score=%.3f'
+              % (n_jobs, perf_counter() - t0, bag.oob_score_))
+    bag.set_params(n_jobs=-1, n_estimators=4).fit(X, y)
+    try:
+        bag.set_params(estimator=KNeighborsClassifier()).fit(X, y)
+    except ValueError as error:
+        print('KNeighborsClassifier: %s' % error)
+    else:
+        raise AssertionError('KNeighborsClassifier was accepted')
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""Isomap for large point sets: approximate kNN graph + landmark MDS
+
+04_07_customizing_colorbars.py projects `load_digits(n_class=6)` with
+`Isomap(n_components=2, n_neighbors=15)`.  Exact Isomap computes all
+pairwise neighbour distances and all-pairs shortest paths, both O(n**2),
+so it stops being practical after a few tens of thousands of points.
+`ApproximateIsomap` replaces each step:
+
+1. **neighbour graph** -- a forest of random-projection trees splits the
+   points at the median of random directions until leaves hold about
+   `leaf_size` points; exact neighbours within each leaf, pooled over the
+   trees, give candidate neighbours, which a few NN-descent rounds
+   ("neighbours of my neighbours are likely my neighbours") then refine,
+2. **geodesics** -- Dijkstra on the sparse kNN graph
+   (`scipy.sparse.csgraph`), run from `n_landmarks` landmark points only,
+   in batches, so memory is O(batch * n) rather than O(n**2),
+3. **embedding** -- landmark MDS (de Silva & Tenenbaum, 2003): classical
+   MDS on the landmark-to-landmark geodesics, and every other point placed
+   by distance-based triangulation from its geodesics to the landmarks.
+
+With ``n_landmarks >= n`` step 3 is exactly classical MDS, i.e. ordinary
+Isomap on the approximate graph.
+
+    iso = ApproximateIsomap(n_components=2, n_neighbors=15)
+    projection = iso.fit_transform(digits.data)
+"""
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+
+
+def _sq_dist(X, Y):
+    """Squared Euclidean distances between matching rows of X and Y blocks"""
+    diff = X - Y
+    return np.einsum('...j,...j->...', diff, diff)
+
+
+def _merge(indices, dists, new_indices, new_dists, k):
+    """Keep the k nearest distinct candidates per row"""
+    indices = np.hstack([indices, new_indices])
+    dists = np.hstack([dists, new_dists])
+    order = np.argsort(indices, axis=1, kind='stable')
+    indices = np.take_along_axis(indices, order, axis=1)
+    dists = np.take_along_axis(dists, order, axis=1)
+    dup = np.zeros(indices.shape, dtype=bool)
+    dup[:, 1:] = indices[:, 1:] == indices[:, :-1]
+    dists[dup] = np.inf
+    best = np.argpartition(dists, k - 1, axis=1)[:, :k]
+    return (np.take_along_axis(indices, best, axis=1),
+            np.take_along_axis(dists, best, axis=1))
+
+
+def _rp_tree_leaves(X, leaf_size, rng):
+    """Index arrays of the leaves of one random-projection tree"""
+    stack, leaves = [np.arange(len(X))], []
+    while stack:
+        node = stack.pop()
+        if len(node) <= leaf_size:
+            leaves.append(node)
+            continue
+        a, b = X[rng.choice(node, 2, replace=False)]
+        projection = X[node] @ (a - b)
+        median = np.median(projection)
+        left = projection < median
+        if left.all() or not left.any():      # duplicate points
+            left = np.arange(len(node)) < len(node) // 2
+        stack.extend([node[left], node[~left]])
+    return leaves
+
+
+def approximate_knn(X, n_neighbors, n_trees=8, leaf_size=None, n_iter=2,
+                    block_size=1024, random_state=None):
+    """Approximate k nearest neighbours (excluding the point itself)
+
+    Returns ``(indices, distances)``, each of shape (n, n_neighbors).
+    """
+    X = np.asarray(X, dtype=np.float64)
+    n, k = len(X), n_neighbors
+    leaf_size = leaf_size or max(2 * (k + 1), 32)
+    rng = np.random.RandomState(random_state)
+
+    indices = np.zeros((n, k), dtype=np.int64)
+    dists = np.full((n, k), np.inf)
+    for _ in range(n_trees):
+        cand_idx = np.zeros((n, k), dtype=np.int64)
+        cand_dist = np.full((n, k), np.inf)
+        for leaf in _rp_tree_leaves(X, leaf_size, rng):
+            d = _sq_dist(X[leaf, np.newaxis], X[np.newaxis, leaf])
+            np.fill_diagonal(d, np.inf)
+            m = min(k, len(leaf) - 1)
+            if m < 1:
+                continue
+            best = np.argpartition(d, m - 1, axis=1)[:, :m]
+            cand_idx[leaf, :m] = leaf[best]
+            cand_dist[leaf, :m] = np.take_along_axis(d, best, axis=1)
+        indices, dists = _merge(indices, dists, cand_idx, cand_dist, k)
+
+    # NN-descent: try the neighbours of each point's neighbours
+    for _ in range(n_iter):
+        new_idx = np.empty_like(indices)
+        new_dist = np.empty_like(dists)
+        for start in range(0, n, block_size):
+            rows = slice(start, min(start + block_size, n))
+            cand = indices[indices[rows]].reshape(-1, k * k)
+            d = _sq_dist(X[rows, np.newaxis], X[cand])
+            d[cand == np.arange(rows.start, rows.stop)[:, np.newaxis]] = np.inf
+            new_idx[rows], new_dist[rows] = _merge(
+                indices[rows], dists[rows], cand, d, k)
+        indices, dists = new_idx, new_dist
+
+    order = np.argsort(dists, axis=1)
+    return (np.take_along_axis(indices, order, axis=1),
+            np.sqrt(np.take_along_axis(dists, order, axis=1)))
+
+
+def knn_graph(indices, distances):
+    """Symmetric sparse graph of the kNN edges"""
+    n, k = indices.shape
+    graph = sparse.csr_matrix(
+        (distances.ravel(), indices.ravel(), np.arange(0, n * k + 1, k)),
+        shape=(n, n))
+    return graph.maximum(graph.T).tocsr()
+
+
+def _connect_components(X, graph, rng, sample=2000):
+    """Join disconnected pieces of the graph to the largest one
+
+    For every smaller component, the closest pair between (a sample of)
+    it and the largest component becomes an extra edge.
+    """
+    n_comp, labels = csgraph.connected_components(graph, directed=False)
+    if n_comp == 1:
+        return graph
+    graph = graph.tolil()
+    main = np.bincount(labels).argmax()
+    main_idx = np.flatnonzero(labels == main)
+    main_idx = rng.choice(main_idx, min(sample, len(main_idx)), replace=False)
+    for c in range(n_comp):
+        if c == main:
+            continue
+        idx = np.flatnonzero(labels == c)
+        idx = rng.choice(idx, min(sample, len(idx)), replace=False)
+        d = _sq_dist(X[idx, np.newaxis], X[np.newaxis, main_idx])
+        i, j = np.unravel_index(d.argmin(), d.shape)
+        graph[idx[i], main_idx[j]] = graph[main_idx[j], idx[i]] = \
+            np.sqrt(d[i, j])
+    return graph.tocsr()
+
+
+class ApproximateIsomap:
+    """Isomap embedding from an approximate kNN graph and landmark MDS"""
+
+    def __init__(self, n_components=2, n_neighbors=15, n_landmarks='auto',
+                 n_trees=8, leaf_size=None, n_iter=2, landmark_batch=64,
+                 random_state=None):
+        self.n_components = n_components
+        self.n_neighbors = n_neighbors
+        self.n_landmarks = n_landmarks
+        self.n_trees = n_trees
+        self.leaf_size = leaf_size
+        self.n_iter = n_iter
+        self.landmark_batch = landmark_batch
+        self.random_state = random_state
+
+    def _geodesics(self, landmarks):
+        for start in range(0, len(landmarks), self.landmark_batch):
+            batch = landmarks[start:start + self.landmark_batch]
+            yield start, csgraph.dijkstra(self.graph_, directed=False,
+                                          indices=batch)
+
+    def fit_transform(self, X, y=None):
+        X = np.asarray(X, dtype=np.float64)
+        n = len(X)
+        rng = np.random.RandomState(self.random_state)
+
+        indices, dists = approximate_knn(
+            X, self.n_neighbors, self.n_trees, self.leaf_size, self.n_iter,
+            random_state=rng.randint(2 ** 31))
+        self.graph_ = _connect_components(X, knn_graph(indices, dists), rng)
+
+        m = self.n_landmarks
+        if m == 'auto':
+            m = n if n <= 2000 else 500
+        m = min(m, n)
+        landmarks = np.arange(n) if m == n else np.sort(
+            rng.choice(n, m, replace=False))
+        self.landmarks_ = landmarks
+
+        # pass 1: squared geodesics between landmarks -> classical MDS
+        delta = np.empty((m, m))
+        for start, D in self._geodesics(landmarks):
+            delta[start:start + len(D)] = D[:, landmarks] ** 2
+        delta = (delta + delta.T) / 2
+        delta_mean = delta.mean(axis=0)
+        B = -0.5 * (delta - delta_mean - delta_mean[:, np.newaxis]
+                    + delta_mean.mean())
+        evals, evecs = np.linalg.eigh(B)
+        top = np.argsort(evals)[::-1][:self.n_components]
+        evals = np.maximum(evals[top], 1e-12)
+        self.eigenvalues_ = evals
+        # pseudo-inverse of the landmark embedding, one column per component
+        pinv = evecs[:, top] / np.sqrt(evals)
+
+        # pass 2: triangulate every point from its landmark geodesics
+        embedding = np.zeros((n, self.n_components))
+        for start, D in self._geodesics(landmarks):
+            rows = slice(start, start + len(D))
+            embedding += (D ** 2 - delta_mean[rows, np.newaxis]).T \
+                @ pinv[rows]
+        self.embedding_ = -0.5 * embedding
+        return self.embedding_
+
+
+if __name__ == '__main__':
+    import sys
+    from time import perf_counter
+    from sklearn.datasets import load_digits
+    from sklearn.manifold import Isomap, trustworthiness
+
+    digits = load_digits(n_class=6)
+    t0 = perf_counter()
+    exact = Isomap(n_components=2, n_neighbors=15).fit_transform(digits.data)
+    t1 = perf_counter()
+    approx = ApproximateIsomap(n_components=2, n_neighbors=15,
+                               random_state=0).fit_transform(digits.data)
+    t2 = perf_counter()
+    print('digits (n=%d): Isomap %.2fs trustworthiness %.3f, '
+          'ApproximateIsomap %.2fs trustworthiness %.3f'
+          % (len(digits.data), t1 - t0,
+             trustworthiness(digits.data, exact, n_neighbors=15),
+             t2 - t1, trustworthiness(digits.data, approx, n_neighbors=15)))
+
+    # many noisy copies of the digits
+    n = int(float(sys.argv[1])) if len(sys.argv) > 1 else 200000
+    rng = np.random.RandomState(0)
+    big = digits.data[rng.randint(0, len(digits.data), n)] \
+        + rng.randn(n, digits.data.shape[1])
+    t0 = perf_counter()
+    ApproximateIsomap(n_components=2, n_neighbors=15, n_landmarks=200,
+                      random_state=0).fit_transform(big)
+    print('%d points: %.1fs' % (n, perf_counter() - t0))
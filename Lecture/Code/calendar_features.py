@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""Vectorized calendar features for the bicycle-traffic model
+
+05_06_linear_regression.py builds its date features one at a time:
+
+    daily['daylight_hrs'] = list(map(hours_of_daylight, daily.index))
+    for i in range(7):
+        daily[days[i]] = (daily.index.dayofweek == i).astype(float)
+    daily = daily.join(pd.Series(1, index=holidays, name='holiday'))
+    daily['annual'] = (daily.index - daily.index[0]).days / 365.
+
+Here every feature is computed as an array straight from a
+`DatetimeIndex`.  The weekday, holiday and daylight columns are computed
+once per daily date range (and latitude) and cached; any index inside that
+range, regular or not, sorted or not, with repeated dates from several
+sites, is then served with a single `take` on day offsets.  Sites at
+different latitudes pass one latitude per row; the daylight column is
+then computed once per distinct (latitude, day) pair.
+
+    features = calendar_features(daily.index)
+    features = calendar_features(counts.index, latitude=counts['lat'])
+    daily = daily.join(features)
+"""
+
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.holiday import USFederalHolidayCalendar
+
+DAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+WINTER_SOLSTICE = pd.Timestamp(2000, 12, 21)
+
+
+def hours_of_daylight(dates, axis=23.44, latitude=47.61):
+    """Compute the hours of daylight for the given dates
+
+    `dates` may be a single date or a DatetimeIndex; `latitude` may be an
+    array broadcasting against it (one latitude per site).
+    """
+    days = (pd.DatetimeIndex(np.atleast_1d(dates)) - WINTER_SOLSTICE).days
+    days = np.asarray(days, dtype=np.float64)
+    m = (1. - np.tan(np.radians(latitude))
+         * np.tan(np.radians(axis) * np.cos(days * 2 * np.pi / 365.25)))
+    hours = 24. * np.degrees(np.arccos(1 - np.clip(m, 0, 2))) / 180.
+    return hours if np.ndim(dates) else hours[0]
+
+
+def weekday_onehot(index):
+    """(n, 7) float array of Monday..Sunday indicators"""
+    return np.eye(7)[np.asarray(index.dayofweek)]
+
+
+def holiday_flags(index, calendar=None):
+    """1.0 on the calendar's holidays, 0.0 elsewhere"""
+    calendar = calendar or USFederalHolidayCalendar()
+    days = index.normalize()
+    holidays = calendar.holidays(days.min(), days.max())
+    return days.isin(holidays).astype(np.float64)
+
+
+@lru_cache(maxsize=32)
+def _daily_table(start, end, latitude, axis):
+    """Weekday, holiday and daylight columns for every day in [start, end]"""
+    days = pd.date_range(start, end, freq='D')
+    table = np.empty((len(days), 9))
+    table[:, :7] = weekday_onehot(days)
+    table[:, 7] = holiday_flags(days)
+    table[:, 8] = hours_of_daylight(days, axis, latitude)
+    table.flags.writeable = False
+    return table
+
+
+def calendar_features(index, latitude=47.61, axis=23.44, origin=None):
+    """DataFrame of the bicycle model's calendar features for `index`
+
+    Columns are ``Mon``..``Sun``, ``holiday``, ``daylight_hrs`` and
+    ``annual`` (years elapsed since `origin`, default the first date of
+    the index, as in the lecture).  `latitude` is one latitude for all rows
+    or an array (or column) with the latitude of each row.
+    """
+    index = pd.DatetimeIndex(index)
+    columns = DAYS + ['holiday', 'daylight_hrs']
+    if not len(index):
+        return pd.DataFrame(np.empty((0, len(columns) + 1)), index=index,
+                            columns=columns + ['annual'])
+    # integer day numbers; cheaper than normalize() and timedelta arithmetic
+    days = index.values.astype('datetime64[D]').astype(np.int64)
+    start, end = days.min(), days.max()
+    start_date = pd.Timestamp(start, unit='D')
+    end_date = pd.Timestamp(end, unit='D')
+    offsets = days - start
+
+    if np.ndim(latitude) == 0:
+        table = _daily_table(start_date, end_date, float(latitude),
+                             float(axis))
+        values = table.take(offsets, axis=0)
+    else:
+        latitude = np.asarray(latitude, dtype=np.float64)
+        if latitude.shape != index.shape:
+            raise ValueError('latitude must be a scalar or have one value '
+                             'per row: %d rows, latitude shape %s'
+                             % (len(index), latitude.shape))
+        # weekday and holiday columns do not depend on the latitude; the
+        # daylight column is computed once per (site, day) pair that occurs
+        table = _daily_table(start_date, end_date, float(latitude[0]),
+                             float(axis))
+        values = table.take(offsets, axis=0)
+        sites, site = np.unique(latitude, return_inverse=True)
+        n_days = end - start + 1
+        pairs, pair = np.unique(site * n_days + offsets, return_inverse=True)
+        dates = (start + pairs % n_days).astype('datetime64[D]')
+        daylight = hours_of_daylight(pd.DatetimeIndex(dates), axis,
+                                     sites[pairs // n_days])
+        values[:, 8] = daylight[pair]
+
+    features = pd.DataFrame(values, index=index, columns=columns)
+
+    if origin is None:
+        origin = days[0]
+    else:
+        origin = np.datetime64(pd.Timestamp(origin), 'D').astype(np.int64)
+    features['annual'] = (days - origin) / 365.
+    return features
+
+
+def clear_cache():
+    """Forget the cached daily tables"""
+    _daily_table.cache_clear()
+
+
+if __name__ == '__main__':
+    from time import perf_counter
+
+    # 40 years of daily data at 50 sites
+    index = pd.DatetimeIndex(np.tile(pd.date_range('1980', '2020', freq='D'),
+                                     50))
+    for label in ('cold', 'cached'):
+        t0 = perf_counter()
+        features = calendar_features(index)
+        print('%-6s %d rows in %.1f ms'
+              % (label, len(features), 1000 * (perf_counter() - t0)))
+
+    # the 50 sites spread over latitudes 30..60
+    latitude = np.repeat(np.linspace(30, 60, 50), len(index) // 50)
+    t0 = perf_counter()
+    features = calendar_features(index, latitude=latitude)
+    print('50 latitudes %d rows in %.1f ms'
+          % (len(features), 1000 * (perf_counter() - t0)))
+    assert np.allclose(features['daylight_hrs'],
+                       hours_of_daylight(index, latitude=latitude))
+    assert features.drop(columns='daylight_hrs').equals(
+        calendar_features(index).drop(columns='daylight_hrs'))
+    # a latitude per row, and no rows at all
+    latitude = np.random.RandomState(0).uniform(-60, 60, len(index))
+    assert np.allclose(calendar_features(index, latitude)['daylight_hrs'],
+                       hours_of_daylight(index, latitude=latitude))
+    empty = calendar_features(index[:0], latitude[:0])
+    assert not len(empty) and list(empty) == list(features)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""Sparse one-hot encoding of categorical columns, without dicts
+
+05_04_feature_engineering.py encodes records such as
+
+    {'price': 850000, 'rooms': 4, 'neighborhood': 'Queen Anne'}
+
+with `DictVectorizer(sparse=False, dtype=int)`.  That walks every dict in
+Python and, with thousands of neighborhoods, the dense output is mostly
+zeros.  `ColumnarEncoder` produces the same features (same names, same
+order) but:
+
+* works on columns (a DataFrame or a dict of arrays); a list of dicts is
+  accepted too and converted once,
+* interns each column's categories into a `pd.Index`, whose hash table maps
+  a whole column of strings to integer codes in one vectorized call,
+* builds the CSR matrix directly from those codes: every row has one entry
+  per categorical column plus its numeric values, so `indptr` and `indices`
+  follow from the codes without any per-record work,
+* keeps the vocabulary frozen after `fit` (or pass one in with
+  `vocabulary=`), so `transform` never rehashes or grows it.  Unknown
+  categories are ignored, as in `DictVectorizer`.
+
+    enc = ColumnarEncoder(dtype=int)
+    enc.fit_transform(pd.DataFrame(data))
+
+Running the module compares it with DictVectorizer on synthetic records
+(``python categorical_encoder.py 10000000`` for 10M).
+"""
+
+import sys
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.base import BaseEstimator, TransformerMixin
+
+
+def _as_frame(X):
+    if isinstance(X, pd.DataFrame):
+        return X
+    if isinstance(X, dict):
+        return pd.DataFrame(X, copy=False)
+    return pd.DataFrame.from_records(list(X))
+
+
+def _is_categorical(column):
+    return not pd.api.types.is_numeric_dtype(column.dtype) \
+        or isinstance(column.dtype, pd.CategoricalDtype)
+
+
+class ColumnarEncoder(BaseEstimator, TransformerMixin):
+    """DictVectorizer-compatible one-hot encoder building CSR directly
+
+    `vocabulary` may map column names to their allowed categories; such
+    columns are not scanned during `fit`.
+    """
+
+    def __init__(self, dtype=np.float64, separator='=', sparse=True,
+                 vocabulary=None):
+        self.dtype = dtype
+        self.separator = separator
+        self.sparse = sparse
+        self.vocabulary = vocabulary
+
+    def fit(self, X, y=None):
+        X = _as_frame(X)
+        given = self.vocabulary or {}
+        self.categories_ = {}
+        names = []
+        for col in X.columns:
+            if col in given:
+                cats = pd.Index(sorted(given[col]))
+            elif _is_categorical(X[col]):
+                cats = pd.Index(np.sort(pd.unique(X[col].dropna())))
+            else:
+                names.append(str(col))
+                continue
+            cats.get_indexer(cats[:1])          # build the hash table now
+            self.categories_[col] = cats
+            names.extend('%s%s%s' % (col, self.separator, c) for c in cats)
+
+        self.feature_names_ = sorted(names)
+        self.vocabulary_ = {name: i for i, name in
+                            enumerate(self.feature_names_)}
+
+        # output position of every numeric column and of every category
+        self.columns_ = list(X.columns)
+        self._offsets = {}
+        for col in self.columns_:
+            if col in self.categories_:
+                self._offsets[col] = np.array(
+                    [self.vocabulary_['%s%s%s' % (col, self.separator, c)]
+                     for c in self.categories_[col]], dtype=np.int32)
+            else:
+                self._offsets[col] = self.vocabulary_[str(col)]
+
+        # columns whose features come first in the output come first in
+        # each row, which keeps CSR indices sorted without a sort when each
+        # column's features are contiguous (the usual case)
+        first = {col: np.min(off) if np.size(off) else sys.maxsize
+                 for col, off in self._offsets.items()}
+        self._order = sorted(self.columns_, key=first.get)
+        self._sorted_rows = all(
+            np.size(off) == 0
+            or np.ptp(off) == np.size(off) - 1 for off in
+            (self._offsets[col] for col in self._order))
+        return self
+
+    def transform(self, X):
+        X = _as_frame(X)
+        n = len(X)
+        indices, data = [], []
+        for col in self._order:
+            if col not in X:
+                continue
+            values = X[col]
+            if col in self.categories_:
+                codes = self.categories_[col].get_indexer(values)
+                known = codes >= 0
+                idx = np.where(known, self._offsets[col][codes], -1)
+                indices.append(idx)
+                data.append(known.astype(self.dtype))
+            else:
+                vals = pd.to_numeric(values).to_numpy(dtype=np.float64)
+                keep = (vals != 0) & ~np.isnan(vals)
+                indices.append(np.where(keep, self._offsets[col], -1))
+                data.append(np.where(keep, vals, 0).astype(self.dtype))
+
+        indices = np.column_stack(indices).astype(np.int32)
+        data = np.column_stack(data)
+        valid = indices >= 0
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(valid.sum(axis=1), out=indptr[1:])
+        out = sparse.csr_matrix((data[valid], indices[valid], indptr),
+                                shape=(n, len(self.feature_names_)),
+                                dtype=self.dtype)
+        if not self._sorted_rows:
+            out.sort_indices()
+        out.has_sorted_indices = True
+        return out if self.sparse else out.toarray()
+
+    def get_feature_names_out(self, input_features=None):
+        return np.array(self.feature_names_, dtype=object)
+
+
+def synthetic_records(n, n_neighborhoods=5000, random_state=0):
+    """Columnar house records with `n_neighborhoods` distinct names"""
+    rng = np.random.RandomState(random_state)
+    names = np.array(['Neighborhood %05d' % i
+                      for i in range(n_neighborhoods)], dtype=object)
+    return pd.DataFrame({
+        'price': rng.randint(300000, 1500000, n),
+        'rooms': rng.randint(1, 8, n),
+        'neighborhood': names[rng.randint(0, n_neighborhoods, n)],
+    })
+
+
+if __name__ == '__main__':
+    from time import perf_counter
+    from sklearn.feature_extraction import DictVectorizer
+
+    n = int(float(sys.argv[1])) if len(sys.argv) > 1 else 1000000
+    frame = synthetic_records(n)
+    records = frame.to_dict('records')
+
+    t0 = perf_counter()
+    X_dict = DictVectorizer(sparse=True, dtype=int).fit_transform(records)
+    t1 = perf_counter()
+    encoder = ColumnarEncoder(dtype=int).fit(frame)
+    t2 = perf_counter()
+    X_col = encoder.transform(frame)
+    t3 = perf_counter()
+    print('%d records' % n)
+    print('DictVectorizer fit_transform   %6.2fs' % (t1 - t0))
+    print('ColumnarEncoder fit            %6.2fs' % (t2 - t1))
+    print('ColumnarEncoder transform      %6.2fs' % (t3 - t2))
+    print('identical output:', (X_dict != X_col).nnz == 0)
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+"""`query()` over a directory of Parquet or Feather chunks
+
+03_12_performance_eval_and_query.py filters an in-memory frame:
+
+    Cmean = df['C'].mean()
+    result2 = df.query('A < @Cmean and B < @Cmean')
+
+`ChunkedTable` runs the same query strings against a table stored as a
+directory of chunk files, so that a 100M-row table never has to fit in
+memory:
+
+* `write_chunks` splits a frame (or an iterable of frames) into chunk
+  files and records, per chunk, the row count and the min, max and null
+  count of every numeric and string column in ``_chunks.json``; for
+  Parquet files written elsewhere the same statistics are read from the
+  file footers,
+* predicate pushdown: the query's comparisons of a column with a constant
+  or ``@variable`` are checked against each chunk's min/max, combined
+  through ``and`` / ``or`` (``&`` / ``|`` mean the same here and bind
+  more loosely than comparisons, as in `DataFrame.query`), and chunks that
+  cannot contain a match are never opened,
+* the remaining chunks are read and filtered in a thread pool (reading and
+  the ufuncs both release the GIL); the filter itself runs through
+  `EvalDispatcher.query`, and only matching rows are kept and concatenated,
+* with `columns`, only the columns the predicate needs are read first, and
+  the requested ones are read only for chunks with matches.
+
+Reading and writing uses pandas' Parquet/Feather support, i.e. `pyarrow`.
+
+    table = ChunkedTable.write_chunks(df, 'table_dir', rows_per_chunk=10**6)
+    table.query('A < @Cmean and B < @Cmean')
+"""
+
+import ast
+import io
+import json
+import os
+import sys
+import tokenize
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from eval_dispatch import EvalDispatcher
+from fused_eval import _LOCAL_PREFIX, parse
+
+MANIFEST = '_chunks.json'
+
+_READERS = {'parquet': pd.read_parquet, 'feather': pd.read_feather}
+_WRITERS = {'parquet': 'to_parquet', 'feather': 'to_feather'}
+_EXTENSIONS = {'parquet': '.parquet', 'feather': '.feather'}
+
+
+def _scalar(value):
+    """JSON-friendly Python scalar, or None for a missing value"""
+    if value is None or pd.isna(value):
+        return None
+    return value.item() if hasattr(value, 'item') else value
+
+
+def chunk_stats(chunk):
+    """Row count and per-column min / max / null count of a frame
+
+    Columns without an order (other dtypes, objects of mixed types) get no
+    statistics, and are never used to skip the chunk.
+    """
+    columns = {}
+    for name, column in chunk.items():
+        if column.dtype.kind not in 'biufOUS':
+            columns[str(name)] = None       # unknown: never prune on it
+            continue
+        nulls = int(column.isna().sum())
+        if nulls == len(column):
+            low = high = None
+        else:
+            try:
+                low, high = column.min(), column.max()
+            except TypeError:               # e.g. str and float objects
+                columns[str(name)] = None
+                continue
+        columns[str(name)] = {'min': _scalar(low), 'max': _scalar(high),
+                              'nulls': nulls}
+    return {'rows': len(chunk), 'columns': columns}
+
+
+def parquet_stats(path):
+    """`chunk_stats` from a Parquet footer, without reading the data"""
+    import pyarrow.parquet as pq
+    metadata = pq.ParquetFile(path).metadata
+    columns = {}
+    for g in range(metadata.num_row_groups):
+        group = metadata.row_group(g)
+        for c in range(group.num_columns):
+            column = group.column(c)
+            stats = column.statistics
+            name = column.path_in_schema
+            if stats is None or not stats.has_min_max:
+                columns[name] = None
+                continue
+            if name in columns and columns[name] is None:
+                continue
+            entry = columns.setdefault(
+                name, {'min': stats.min, 'max': stats.max, 'nulls': 0})
+            entry['min'] = min(entry['min'], stats.min)
+            entry['max'] = max(entry['max'], stats.max)
+            entry['nulls'] += stats.null_count or 0
+    return {'rows': metadata.num_rows, 'columns': columns}
+
+
+def _schema(frame):
+    """Column name -> dtype name, enough to rebuild an empty frame"""
+    return {str(name): str(dtype) for name, dtype in frame.dtypes.items()}
+
+
+def _replace_booleans(expr):
+    """`expr` with ``&`` / ``|`` as ``and`` / ``or``
+
+    In Python ``A > 0.5 & B < 0.1`` means ``A > (0.5 & B) < 0.1``; in a
+    query, as for `DataFrame.query`, the comparisons bind more tightly.
+    """
+    if '&' not in expr and '|' not in expr:
+        return expr
+    words = {'&': 'and', '|': 'or'}
+    tokens = [(tokenize.NAME, words[text])
+              if kind == tokenize.OP and text in words else (kind, text)
+              for kind, text, _, _, _ in tokenize.generate_tokens(
+                  io.StringIO(expr).readline)]
+    return tokenize.untokenize(tokens).strip()
+
+
+# can `column <op> value` hold for some row with values in [low, high]?
+_MAY_MATCH = {
+    ast.Lt: lambda low, high, v: low < v,
+    ast.LtE: lambda low, high, v: low <= v,
+    ast.Gt: lambda low, high, v: high > v,
+    ast.GtE: lambda low, high, v: high >= v,
+    ast.Eq: lambda low, high, v: low <= v <= high,
+}
+_FLIPPED = {ast.Lt: ast.Gt, ast.LtE: ast.GtE, ast.Gt: ast.Lt,
+            ast.GtE: ast.LtE, ast.Eq: ast.Eq, ast.NotEq: ast.NotEq}
+
+
+class _Pruner:
+    """Decide from chunk statistics whether a chunk may match a query"""
+
+    def __init__(self, expr, columns, local_dict, global_dict):
+        self.tree = parse(expr).value
+        self.columns = set(columns)
+        self.local_dict = local_dict
+        self.global_dict = global_dict
+
+    def operand(self, node):
+        """``('column', name)``, ``('value', v)`` or None if unknown"""
+        if isinstance(node, ast.Name):
+            if node.id.startswith(_LOCAL_PREFIX):
+                name = node.id[len(_LOCAL_PREFIX):]
+                scope = (self.local_dict if name in self.local_dict
+                         else self.global_dict)
+                return ('value', scope[name]) if name in scope else None
+            if node.id in self.columns:
+                return ('column', node.id)
+            for scope in (self.local_dict, self.global_dict):
+                if node.id in scope:
+                    return ('value', scope[node.id])
+            return None
+        if isinstance(node, ast.Constant):
+            return ('value', node.value)
+        if (isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub)
+                and isinstance(node.operand, ast.Constant)):
+            return ('value', -node.operand.value)
+        return None
+
+    def may_match(self, stats, node=None):
+        node = self.tree if node is None else node
+        if isinstance(node, ast.BoolOp) or (
+                isinstance(node, ast.BinOp)
+                and isinstance(node.op, (ast.BitAnd, ast.BitOr))):
+            values = (node.values if isinstance(node, ast.BoolOp)
+                      else [node.left, node.right])
+            results = [self.may_match(stats, v) for v in values]
+            if isinstance(node.op, (ast.And, ast.BitAnd)):
+                return all(results)
+            return any(results)
+        if isinstance(node, ast.Compare):
+            operands = [node.left] + node.comparators
+            return all(self._compare(stats, op, left, right)
+                       for op, left, right
+                       in zip(node.ops, operands, operands[1:]))
+        return True
+
+    def _compare(self, stats, op, left, right):
+        left, right = self.operand(left), self.operand(right)
+        if left is None or right is None or left[0] == right[0]:
+            return True
+        if type(op) not in _FLIPPED:        # in, is, ...
+            return True
+        if left[0] == 'value':
+            left, right, op = right, left, _FLIPPED[type(op)]()
+        column = stats['columns'].get(left[1])
+        value = right[1]
+        if column is None:
+            return True
+        low, high = column['min'], column['max']
+        if low is None:                     # only missing values
+            return isinstance(op, ast.NotEq)
+        if isinstance(op, ast.NotEq):
+            return not (low == high == value and column['nulls'] == 0)
+        try:
+            return bool(_MAY_MATCH[type(op)](low, high, value))
+        except (KeyError, TypeError):       # other ops, mixed types
+            return True
+
+
+class ChunkedTable:
+    """A table stored as chunk files in `directory`"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        path = os.path.join(directory, MANIFEST)
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            self.file_format = manifest['format']
+            self.files = [c['file'] for c in manifest['chunks']]
+            self.stats = manifest['chunks']
+            self.schema = manifest.get('schema')
+        else:
+            # Parquet files from elsewhere: statistics from the footers
+            self.file_format = 'parquet'
+            self.files = sorted(f for f in os.listdir(directory)
+                                if f.endswith('.parquet'))
+            self.stats = [parquet_stats(os.path.join(directory, f))
+                          for f in self.files]
+            self.schema = None
+            if self.files:
+                import pyarrow.parquet as pq
+                self.schema = _schema(pq.read_schema(os.path.join(
+                    directory, self.files[0])).empty_table().to_pandas())
+        self.columns = list(self.stats[0]['columns']) if self.stats else []
+
+    def __len__(self):
+        return sum(s['rows'] for s in self.stats)
+
+    @classmethod
+    def write_chunks(cls, data, directory, rows_per_chunk=1000000,
+                     file_format='parquet'):
+        """Write a frame, or an iterable of frames, as chunk files
+
+        `file_format` is 'parquet' or 'feather'.
+        """
+        os.makedirs(directory, exist_ok=True)
+        if isinstance(data, pd.DataFrame):
+            frame = data
+            data = (frame.iloc[start:start + rows_per_chunk]
+                    for start in range(0, len(frame), rows_per_chunk))
+        chunks = []
+        schema = None
+        for i, chunk in enumerate(data):
+            name = 'chunk-%05d%s' % (i, _EXTENSIONS[file_format])
+            chunk = chunk.reset_index(drop=True)
+            getattr(chunk, _WRITERS[file_format])(
+                os.path.join(directory, name))
+            chunks.append(dict(file=name, **chunk_stats(chunk)))
+            schema = schema or _schema(chunk)
+        with open(os.path.join(directory, MANIFEST), 'w') as f:
+            json.dump({'format': file_format, 'chunks': chunks,
+                       'schema': schema}, f)
+        return cls(directory)
+
+    def read(self, i, columns=None):
+        return _READERS[self.file_format](
+            os.path.join(self.directory, self.files[i]), columns=columns)
+
+    def empty(self, columns=None):
+        """Frame with no rows and the columns and dtypes of the table"""
+        if self.schema is None:             # manifest of an older version
+            return (self.read(0, columns) if self.files
+                    else pd.DataFrame()).iloc[:0]
+        names = list(self.schema) if columns is None else columns
+        return pd.DataFrame({name: pd.Series(dtype=self.schema[name])
+                             for name in names})
+
+    def candidates(self, expr, local_dict=None, global_dict=None):
+        """Indices of the chunks whose statistics allow a match"""
+        pruner = _Pruner(_replace_booleans(expr), self.columns,
+                         local_dict or {}, global_dict or {})
+        return [i for i, stats in enumerate(self.stats)
+                if pruner.may_match(stats)]
+
+    def query(self, expr, columns=None, n_jobs=None, local_dict=None,
+              global_dict=None, level=0, dispatcher=None):
+        """Matching rows of all chunks, as one DataFrame
+
+        `columns` restricts the returned columns.  The result has a fresh
+        RangeIndex.
+        """
+        if local_dict is None and global_dict is None:
+            frame = sys._getframe(level + 1)
+            local_dict, global_dict = frame.f_locals, frame.f_globals
+        dispatcher = dispatcher or EvalDispatcher()
+        expr = _replace_booleans(expr)
+        predicate_columns = None
+        if columns is not None:
+            names = {n.id for n in ast.walk(parse(expr))
+                     if isinstance(n, ast.Name)}
+            predicate_columns = [c for c in self.columns if c in names]
+
+        def filter_chunk(i):
+            chunk = self.read(i, predicate_columns)
+            mask = np.asarray(dispatcher.eval(expr, chunk, local_dict,
+                                              global_dict), dtype=bool)
+            if not mask.any():
+                return None
+            if columns is not None:
+                chunk = self.read(i, columns)
+            return chunk[mask]
+
+        selected = self.candidates(expr, local_dict, global_dict)
+        n_jobs = n_jobs or os.cpu_count()
+        with ThreadPoolExecutor(n_jobs) as pool:
+            pieces = [p for p in pool.map(filter_chunk, selected)
+                      if p is not None]
+        self.last_scanned = len(selected)
+        if not pieces:
+            return self.empty(columns)
+        return pd.concat(pieces, ignore_index=True)
+
+
+if __name__ == '__main__':
+    import tempfile
+    from time import perf_counter
+
+    n_rows = int(float(sys.argv[1])) if len(sys.argv) > 1 else 100000000
+    rows_per_chunk = 2000000
+    directory = tempfile.mkdtemp()
+
+    # a time-ordered table: A drifts upwards, so most chunks can be skipped
+    rng = np.random.default_rng(42)
+
+    def generate():
+        for start in range(0, n_rows, rows_per_chunk):
+            n = min(rows_per_chunk, n_rows - start)
+            yield pd.DataFrame({
+                'A': (start + np.arange(n)) / n_rows + rng.random(n) * 0.01,
+                'B': rng.random(n), 'C': rng.random(n)})
+
+    t0 = perf_counter()
+    table = ChunkedTable.write_chunks(generate(), directory, rows_per_chunk)
+    print('wrote %d rows in %d chunks: %.1fs'
+          % (len(table), len(table.files), perf_counter() - t0))
+
+    Cmean = 0.05
+    for expr in ['A < @Cmean and B < @Cmean', 'B < @Cmean and C > 0.99']:
+        t0 = perf_counter()
+        result = table.query(expr)
+        print('%-28s %9d rows, %3d of %d chunks read, %.1fs'
+              % (expr, len(result), table.last_scanned, len(table.files),
+                 perf_counter() - t0))
+
+    # '&' binds like 'and' in a query; no match still gives the columns
+    assert table.query('A > 0.99 & B < @Cmean').equals(
+        table.query('A > 0.99 and B < @Cmean'))
+    empty = table.query('A > 2')
+    assert not len(empty) and list(empty) == ['A', 'B', 'C']
+    assert table.last_scanned == 0
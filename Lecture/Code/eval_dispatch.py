@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""Choose the eval/query backend from the size of the temporaries
+
+The closing notes of 03_12_performance_eval_and_query.py:
+
+    df.values.nbytes
+
+    ... The issue is how your temporary objects compare to the size of
+    the L1 or L2 CPU cache on your system (typically a few megabytes) ...
+    if anything, the traditional method is faster for smaller arrays!
+
+`EvalDispatcher` turns that rule of thumb into a decision per call:
+
+* the expression is compiled (`fused_eval.compile_expression`) and the
+  bytes of temporaries plain NumPy would allocate are estimated as one
+  full-size array per intermediate operation; for ``df1 + df2 + df3``
+  that is ``2 * df1.values.nbytes``,
+* below `crossover_bytes` it uses the traditional path: one ufunc call
+  per operator over whole arrays,
+* up to `memory_budget` it uses numexpr (``pd.eval(engine='numexpr')``)
+  if installed, otherwise the blocked, threaded `fused_eval` engine,
+* above that, the chunked path evaluates row chunks one at a time, so the
+  temporaries of only one chunk are alive at once,
+* the backend that actually ran (``'fused'`` when numexpr is missing or
+  cannot handle the expression) is logged (logger ``eval_dispatch``, level
+  INFO) and kept in `last_backend`.
+
+`calibrate` measures the crossover on the current machine, against numexpr
+or, if it is not installed, the fused engine.
+
+    dispatcher = EvalDispatcher()
+    dispatcher.calibrate()
+    dispatcher.eval('(A + B) / (C - 1)', df)
+    dispatcher.query(df, 'A < @Cmean and B < @Cmean')
+"""
+
+import logging
+import os
+import sys
+from timeit import repeat
+
+import numpy as np
+import pandas as pd
+
+from fused_eval import compile_expression, fused_eval, resolve
+
+logger = logging.getLogger('eval_dispatch')
+
+try:
+    import numexpr  # noqa: F401
+    HAS_NUMEXPR = True
+except ImportError:
+    HAS_NUMEXPR = False
+
+# typical L2 cache size, until `calibrate` has measured the crossover
+DEFAULT_CROSSOVER_BYTES = 2 * 1024 ** 2
+
+
+def physical_memory():
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return 8 * 1024 ** 3
+
+
+def temporary_bytes(plan, values):
+    """Bytes of temporaries NumPy allocates to evaluate `plan` on `values`
+
+    One array of the broadcast shape per operation except the last, which
+    produces the result.
+    """
+    arrays = [np.asarray(v) for v in values]
+    if not arrays:
+        return 0
+    size = int(np.prod(np.broadcast_shapes(*[a.shape for a in arrays])))
+    itemsize = max(a.dtype.itemsize for a in arrays)
+    return max(len(plan.instructions) - 1, 0) * size * itemsize
+
+
+class EvalDispatcher:
+    """Pick numpy, numexpr (or fused) or chunked evaluation per expression"""
+
+    def __init__(self, crossover_bytes=DEFAULT_CROSSOVER_BYTES,
+                 memory_budget=None, chunk_bytes=64 * 1024 ** 2):
+        self.crossover_bytes = crossover_bytes
+        self.memory_budget = memory_budget or physical_memory() // 4
+        self.chunk_bytes = chunk_bytes
+        self.last_backend = None
+
+    def choose(self, plan, values):
+        """``(backend, estimated temporary bytes)``"""
+        nbytes = temporary_bytes(plan, values)
+        if nbytes < self.crossover_bytes:
+            return 'numpy', nbytes
+        if nbytes <= self.memory_budget:
+            return ('numexpr' if HAS_NUMEXPR else 'fused'), nbytes
+        return 'chunked', nbytes
+
+    def eval(self, expr, df=None, local_dict=None, global_dict=None,
+             level=0):
+        """Evaluate `expr` like `pd.eval`, or `df.eval` if `df` is given"""
+        if local_dict is None and global_dict is None:
+            frame = sys._getframe(level + 1)
+            local_dict, global_dict = frame.f_locals, frame.f_globals
+        plan = compile_expression(expr)
+        values = resolve(plan, df, local_dict, global_dict)
+        backend, nbytes = self.choose(plan, values)
+        # the backend methods record what they fall back to
+        self.last_backend = backend
+        result = getattr(self, '_' + backend)(expr, df, local_dict,
+                                              global_dict, nbytes)
+        logger.info('%r: %.1f MB of temporaries -> %s',
+                    expr, nbytes / 1e6, self.last_backend)
+        return result
+
+    def query(self, df, expr, local_dict=None, global_dict=None, level=0):
+        """Rows of `df` where the boolean expression `expr` holds"""
+        if local_dict is None and global_dict is None:
+            frame = sys._getframe(level + 1)
+            local_dict, global_dict = frame.f_locals, frame.f_globals
+        mask = self.eval(expr, df, local_dict, global_dict)
+        return df[np.asarray(mask, dtype=bool)]
+
+    def _numpy(self, expr, df, local_dict, global_dict, nbytes):
+        # one block covering everything: a ufunc per operator, full-size
+        # temporaries, no threads
+        return fused_eval(expr, df, local_dict, global_dict, n_threads=1,
+                          block_bytes=sys.maxsize)
+
+    def _fused(self, expr, df, local_dict, global_dict, nbytes):
+        self.last_backend = 'fused'
+        return fused_eval(expr, df, local_dict, global_dict)
+
+    def _numexpr(self, expr, df, local_dict, global_dict, nbytes):
+        if HAS_NUMEXPR:
+            try:
+                if df is None:
+                    return pd.eval(expr, engine='numexpr',
+                                   local_dict=local_dict,
+                                   global_dict=global_dict)
+                return df.eval(expr, engine='numexpr',
+                               local_dict=local_dict,
+                               global_dict=global_dict)
+            except (NotImplementedError, ValueError, TypeError,
+                    SyntaxError) as error:
+                logger.info('numexpr cannot evaluate %r (%s), using the '
+                            'fused engine', expr, error)
+        return self._fused(expr, df, local_dict, global_dict, nbytes)
+
+    def _chunked(self, expr, df, local_dict, global_dict, nbytes):
+        # the fused engine already keeps only block-sized temporaries
+        if not HAS_NUMEXPR or df is None \
+                or compile_expression(expr).target is not None:
+            return self._fused(expr, df, local_dict, global_dict, nbytes)
+        n_chunks = -(-nbytes // self.chunk_bytes)
+        step = -(-len(df) // n_chunks)
+        return pd.concat([
+            df.iloc[start:start + step].eval(expr, engine='numexpr',
+                                             local_dict=local_dict,
+                                             global_dict=global_dict)
+            for start in range(0, len(df), step)])
+
+    def calibrate(self, expr='(x > 0.5) & (y < 0.5) | (x * y > 0.25)',
+                  sizes=None, n_repeat=5, random_state=0):
+        """Time the numpy and numexpr paths and set `crossover_bytes`
+
+        Without numexpr the fused engine, which then runs in its place, is
+        timed instead.  Returns a list of ``(temporary bytes, numpy seconds,
+        numexpr or fused seconds)``; the crossover is the smallest size from
+        which that path wins at every larger size.
+        """
+        sizes = sizes or [2 ** k for k in range(8, 25, 2)]
+        rng = np.random.default_rng(random_state)
+        plan = compile_expression(expr)
+        middle = self._numexpr if HAS_NUMEXPR else self._fused
+        table = []
+        for n in sizes:
+            namespace = {'x': rng.random(n), 'y': rng.random(n)}
+            values = resolve(plan, None, namespace)
+            nbytes = temporary_bytes(plan, values)
+            times = [min(repeat(lambda: run(expr, None, namespace, {},
+                                            nbytes),
+                                number=1, repeat=n_repeat))
+                     for run in (self._numpy, middle)]
+            table.append((nbytes, times[0], times[1]))
+
+        self.crossover_bytes = np.inf
+        for nbytes, t_numpy, t_middle in reversed(table):
+            if t_middle >= t_numpy:
+                break
+            self.crossover_bytes = nbytes
+        logger.info('calibrated crossover: %.2f MB of temporaries',
+                    self.crossover_bytes / 1e6)
+        return table
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(name)s: %(message)s')
+
+    dispatcher = EvalDispatcher()
+    print('%12s %10s %10s' % ('temporaries', 'numpy',
+                              'numexpr' if HAS_NUMEXPR else 'fused'))
+    for nbytes, t_numpy, t_middle in dispatcher.calibrate():
+        print('%10.2fMB %8.3fms %8.3fms'
+              % (nbytes / 1e6, 1000 * t_numpy, 1000 * t_middle))
+
+    rng = np.random.default_rng(42)
+    for nrows in [100, 1000000]:
+        df = pd.DataFrame(rng.random((nrows, 3)), columns=['A', 'B', 'C'])
+        Cmean = df['C'].mean()
+        dispatcher.eval('(A + B) / (C - 1)', df)
+        dispatcher.query(df, 'A < @Cmean and B < @Cmean')
+    # pretend memory is tight to show the chunked path
+    tight = EvalDispatcher(memory_budget=1)
+    tight.eval('(A + B) / (C - 1)', df)
+    assert tight.last_backend == ('chunked' if HAS_NUMEXPR else 'fused')
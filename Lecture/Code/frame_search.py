@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""Index-backed searching for the Lecture10 logic-based searching notebook
+
+lec10_DataFrame_logic_base_searching.ipynb answers every question with a
+full scan, and the first one with a full NaN-masked copy of the frame:
+
+    df[df.isin(['Mexico'])].stack().index.tolist()
+    df[(df['Units Sold'] >= 1000) & (df['Units Sold'] <= 2000)
+       & (df['Country'] == 'France')]
+
+`FrameSearcher` builds per-column indexes on first use and reuses them for
+every later query:
+
+* `SortedIndex`: the column's row positions in value order, so a range
+  predicate is two `searchsorted` calls,
+* `HashIndex`: a dict from each distinct value to a slice of row
+  positions grouped by value, for equality and `isin`,
+* queries return sorted int64 row positions, never a copy of the frame
+  (``df.iloc[positions]`` or `take` when the rows are wanted); combined
+  predicates start from the most selective indexed one and check the
+  rest on just those rows.
+
+Indexes describe the frame as it was when they were built; call `reset`
+after modifying it.
+
+    search = FrameSearcher(df)
+    search.locate(['Mexico'])                    # [(row, column), ...]
+    search.select([('Units Sold', 'between', (1000, 2000)),
+                   ('Country', '==', 'France')])
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class SortedIndex:
+    """Row positions of a column in ascending value order"""
+
+    def __init__(self, values):
+        values = np.asarray(values)
+        missing = pd.isna(values)
+        valid = np.flatnonzero(~missing)
+        order = np.argsort(values[valid], kind='stable')
+        self.positions = valid[order]
+        self.values = values[self.positions]
+
+    def range(self, low=None, high=None, inclusive='both'):
+        """Sorted positions with ``low <= value <= high`` (None: open)
+
+        `inclusive` is 'both', 'neither', 'left' or 'right', as in
+        `Series.between`.
+        """
+        start, stop = 0, len(self.values)
+        if low is not None:
+            side = 'left' if inclusive in ('both', 'left') else 'right'
+            start = np.searchsorted(self.values, low, side=side)
+        if high is not None:
+            side = 'right' if inclusive in ('both', 'right') else 'left'
+            stop = np.searchsorted(self.values, high, side=side)
+        return np.sort(self.positions[start:max(start, stop)])
+
+    def count(self, low=None, high=None, inclusive='both'):
+        """Number of rows `range` would return, without gathering them"""
+        start, stop = 0, len(self.values)
+        if low is not None:
+            side = 'left' if inclusive in ('both', 'left') else 'right'
+            start = np.searchsorted(self.values, low, side=side)
+        if high is not None:
+            side = 'right' if inclusive in ('both', 'right') else 'left'
+            stop = np.searchsorted(self.values, high, side=side)
+        return max(stop - start, 0)
+
+
+class HashIndex:
+    """Distinct value -> sorted row positions holding it"""
+
+    def __init__(self, values):
+        codes, uniques = pd.factorize(np.asarray(values))
+        valid = codes >= 0                       # factorize marks NaN as -1
+        self.positions = np.flatnonzero(valid)[
+            np.argsort(codes[valid], kind='stable')]
+        counts = np.bincount(codes[valid], minlength=len(uniques))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.lookup = {value: i for i, value in enumerate(uniques)}
+
+    def __contains__(self, value):
+        return value in self.lookup
+
+    def get(self, value):
+        code = self.lookup.get(value)
+        if code is None:
+            return np.empty(0, dtype=np.int64)
+        return self.positions[self.offsets[code]:self.offsets[code + 1]]
+
+    def count(self, value):
+        code = self.lookup.get(value)
+        return 0 if code is None else int(self.offsets[code + 1]
+                                          - self.offsets[code])
+
+    def isin(self, values):
+        codes = sorted({self.lookup[v] for v in values if v in self.lookup})
+        if not codes:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(np.concatenate([
+            self.positions[self.offsets[c]:self.offsets[c + 1]]
+            for c in codes]))
+
+
+_RANGE_OPS = {'<': (None, 'neither'), '<=': (None, 'right'),
+              '>': ('neither', None), '>=': ('left', None)}
+
+
+class FrameSearcher:
+    """Per-column indexes over `df`, built lazily and reused"""
+
+    def __init__(self, df):
+        self.df = df
+        self.reset()
+
+    def reset(self):
+        """Forget all indexes (after the frame was modified)"""
+        self._sorted = {}
+        self._hashed = {}
+
+    def sorted_index(self, column):
+        if column not in self._sorted:
+            self._sorted[column] = SortedIndex(self.df[column].to_numpy())
+        return self._sorted[column]
+
+    def hash_index(self, column):
+        if column not in self._hashed:
+            self._hashed[column] = HashIndex(self.df[column].to_numpy())
+        return self._hashed[column]
+
+    def equal(self, column, value):
+        return self.hash_index(column).get(value)
+
+    def isin(self, column, values):
+        return self.hash_index(column).isin(values)
+
+    def between(self, column, low, high, inclusive='both'):
+        return self.sorted_index(column).range(low, high, inclusive)
+
+    def compare(self, column, op, value):
+        """Positions where ``column <op> value``
+
+        `op` is one of ==, !=, <, <=, >, >=, 'isin' or 'between' (with a
+        ``(low, high)`` value).
+        """
+        if op == '==':
+            return self.equal(column, value)
+        if op == 'isin':
+            return self.isin(column, value)
+        if op == 'between':
+            return self.between(column, *value)
+        if op == '!=':
+            # NaN != value holds, as with pandas' boolean masks
+            return np.setdiff1d(np.arange(len(self.df)),
+                                self.equal(column, value),
+                                assume_unique=True)
+        if op in _RANGE_OPS:
+            low_side, high_side = _RANGE_OPS[op]
+            if low_side is None:
+                return self.sorted_index(column).range(
+                    None, value, high_side)
+            return self.sorted_index(column).range(value, None, low_side)
+        raise ValueError('unknown operator %r' % (op,))
+
+    def _estimate(self, column, op, value):
+        """Cheap row-count estimate used to order the predicates"""
+        if op == '==':
+            return self.hash_index(column).count(value)
+        if op == 'isin':
+            index = self.hash_index(column)
+            return sum(index.count(v) for v in set(value))
+        if op == 'between':
+            return self.sorted_index(column).count(*value)
+        if op in _RANGE_OPS:
+            low_side, high_side = _RANGE_OPS[op]
+            index = self.sorted_index(column)
+            if low_side is None:
+                return index.count(None, value, high_side)
+            return index.count(value, None, low_side)
+        return len(self.df)
+
+    def select(self, predicates, how='and'):
+        """Sorted positions matching all (`how='and'`) or any predicates
+
+        `predicates` is a list of ``(column, op, value)`` as in `compare`.
+        With 'and', only the most selective predicate uses its index; the
+        others are checked on the gathered values of its rows.
+        """
+        predicates = list(predicates)
+        if how == 'or':
+            return np.unique(np.concatenate(
+                [self.compare(*p) for p in predicates]
+                + [np.empty(0, dtype=np.int64)]))
+        if how != 'and':
+            raise ValueError("how must be 'and' or 'or', got %r" % (how,))
+        predicates.sort(key=lambda p: self._estimate(*p))
+        positions = self.compare(*predicates[0])
+        for column, op, value in predicates[1:]:
+            if not len(positions):
+                break
+            # gather only the candidate rows, not the whole column
+            values = self.df[column].take(positions).to_numpy()
+            positions = positions[_mask(values, op, value)]
+        return positions
+
+    def any(self, values):
+        """Per column: does it contain any of `values` (``df.isin().any()``)
+
+        Numeric columns are only consulted for numeric values.
+        """
+        return pd.Series({column: any(v in self._candidate(column, v)
+                                      for v in values)
+                          for column in self.df.columns})
+
+    def locate(self, values):
+        """``(row label, column)`` of every cell equal to one of `values`
+
+        Same result and order as
+        ``df[df.isin(values)].stack().index.tolist()`` gave before pandas
+        3, whose `stack` no longer drops the NaN cells.
+        """
+        rows, cols = [], []
+        for j, column in enumerate(self.df.columns):
+            hits = [v for v in values if v in self._candidate(column, v)]
+            if hits:
+                positions = self.hash_index(column).isin(hits)
+                rows.append(positions)
+                cols.append(np.full(len(positions), j))
+        if not rows:
+            return []
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        order = np.lexsort((cols, rows))
+        labels = self.df.index[rows[order]]
+        names = self.df.columns[cols[order]]
+        return list(zip(labels, names))
+
+    def _candidate(self, column, value):
+        """The hash index of `column`, if `value` could occur in it"""
+        numeric = self.df[column].dtype.kind in 'biufc'
+        if numeric != isinstance(value, (bool, int, float, np.number)):
+            return ()
+        return self.hash_index(column)
+
+    def take(self, positions):
+        return self.df.iloc[positions]
+
+
+def _mask(values, op, value):
+    if op == 'isin':
+        return pd.Series(values).isin(value).to_numpy()
+    if op == 'between':
+        low, high = value
+        return (values >= low) & (values <= high)
+    return {'==': np.equal, '!=': np.not_equal, '<': np.less,
+            '<=': np.less_equal, '>': np.greater,
+            '>=': np.greater_equal}[op](values, value)
+
+
+if __name__ == '__main__':
+    import sys
+    from timeit import timeit
+
+    sample = pd.read_csv('sample_data.csv')
+    search = FrameSearcher(sample)
+    found = sample.isin(['Mexico']).stack()
+    assert search.locate(['Mexico']) == found[found].index.tolist()
+    assert search.any(['Mexico']).equals(sample.isin(['Mexico']).any())
+
+    # a large frame of resampled sales rows
+    n = int(float(sys.argv[1])) if len(sys.argv) > 1 else 2000000
+    rng = np.random.RandomState(0)
+    df = sample.iloc[rng.randint(0, len(sample), n)].reset_index(drop=True)
+    df['Units Sold'] += rng.randint(0, 100, n)
+
+    query = [('Units Sold', 'between', (1000, 2000)),
+             ('Country', '==', 'France')]
+    search = FrameSearcher(df)
+    t_build = timeit(lambda: search.select(query), number=1)
+    expected = np.flatnonzero((df['Units Sold'] >= 1000)
+                              & (df['Units Sold'] <= 2000)
+                              & (df['Country'] == 'France'))
+    assert np.array_equal(search.select(query), expected)
+
+    n_queries = 20
+    t_mask = timeit(lambda: df[(df['Units Sold'] >= 1000)
+                               & (df['Units Sold'] <= 2000)
+                               & (df['Country'] == 'France')],
+                    number=n_queries) / n_queries
+    t_index = timeit(lambda: search.select(query),
+                     number=n_queries) / n_queries
+    t_locate_mask = timeit(
+        lambda: df[df.isin(['Mexico'])].stack().index.tolist(), number=1)
+    t_locate_build = timeit(lambda: search.locate(['Mexico']), number=1)
+    t_locate = timeit(lambda: search.locate(['Mexico']), number=1)
+    print('%d rows' % n)
+    print('range + equality: boolean mask %.1fms, index %.2fms '
+          '(first query incl. building the indexes: %.0fms)'
+          % (1000 * t_mask, 1000 * t_index, 1000 * t_build))
+    print("locate 'Mexico':  isin().stack() %.0fms, index %.0fms "
+          '(first call incl. building the indexes: %.0fms)'
+          % (1000 * t_locate_mask, 1000 * t_locate, 1000 * t_locate_build))
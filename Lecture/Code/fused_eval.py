@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+"""Fused, blocked evaluation of compound array expressions
+
+03_12_performance_eval_and_query.py shows why compound expressions are
+slow in NumPy: in
+
+    mask = (x > 0.5) & (y < 0.5)
+
+every subexpression is a full-size temporary.  `numexpr` and `pd.eval`
+avoid that, but only for the operators `pd.eval` knows.  `fused_eval`
+takes the same string syntax plus function calls (`sqrt`, `exp`, `log`,
+`abs`, ... and `where(cond, a, b)`) and:
+
+* parses the string once into a plan, a short list of ufunc
+  instructions; plans are cached by expression text,
+* evaluates the plan block by block: each block of about `block_bytes`
+  per operand runs through the whole instruction list in a few scratch
+  buffers that stay in cache, and the last instruction writes straight
+  into the output,
+* spreads the blocks over threads (NumPy releases the GIL inside ufuncs),
+* computes subexpressions that do not depend on the blocked axis
+  (``@column_mean * 2``, a row broadcast against a frame) once.
+
+Names resolve like `pd.eval` (the caller's namespace) or, given `df`,
+like `DataFrame.eval` (columns, and ``@name`` for local variables);
+``D = A + B`` assigns a column.  DataFrame and Series results keep the
+index and columns of the inputs, which must already be aligned.
+
+    fused_eval('df1 + df2 + df3 + df4')
+    fused_eval('where(A > 0.5, sqrt(B) * C, -C)', df=df)
+"""
+
+import ast
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+BLOCK_BYTES = 256 * 1024
+
+_BINOPS = {
+    ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply,
+    ast.Div: np.true_divide, ast.FloorDiv: np.floor_divide,
+    ast.Mod: np.remainder, ast.Pow: np.power, ast.BitAnd: np.bitwise_and,
+    ast.BitOr: np.bitwise_or, ast.BitXor: np.bitwise_xor,
+}
+_UNARYOPS = {ast.USub: np.negative, ast.UAdd: np.positive,
+             ast.Invert: np.invert, ast.Not: np.logical_not}
+_COMPARISONS = {ast.Lt: np.less, ast.LtE: np.less_equal,
+                ast.Gt: np.greater, ast.GtE: np.greater_equal,
+                ast.Eq: np.equal, ast.NotEq: np.not_equal}
+_BOOLOPS = {ast.And: np.logical_and, ast.Or: np.logical_or}
+
+FUNCTIONS = {name: getattr(np, name) for name in [
+    'sin', 'cos', 'tan', 'arcsin', 'arccos', 'arctan', 'arctan2', 'sinh',
+    'cosh', 'tanh', 'exp', 'expm1', 'log', 'log1p', 'log10', 'sqrt',
+    'square', 'absolute', 'floor', 'ceil', 'minimum', 'maximum', 'isnan',
+    'fmod', 'hypot']}
+FUNCTIONS['abs'] = np.absolute
+FUNCTIONS['where'] = 'where'
+
+# `@name` is not valid Python; it is rewritten to a prefixed name
+_LOCAL_PREFIX = '__local_'
+_LOCAL_RE = re.compile(r'@([A-Za-z_]\w*)')
+
+
+class Plan:
+    """Compiled expression: leaf sources and a list of instructions
+
+    Instruction ``j`` computes register ``j`` as ``func(*args)``; an
+    argument is ``('leaf', i)``, ``('reg', j)`` or ``('const', value)``.
+    """
+
+    def __init__(self, text, target, leaves, instructions, result):
+        self.text = text
+        self.target = target
+        self.leaves = leaves
+        self.instructions = instructions
+        self.result = result
+        self.last_use = {}
+        for j, (_, args) in enumerate(instructions):
+            for kind, value in args:
+                if kind == 'reg':
+                    self.last_use[value] = j
+
+    def __repr__(self):
+        return 'Plan(%r, %d leaves, %d instructions)' % (
+            self.text, len(self.leaves), len(self.instructions))
+
+    def evaluate(self, values, n_threads=None, block_bytes=BLOCK_BYTES):
+        """Evaluate on `values` (one per leaf); returns an ndarray"""
+        arrays = [np.asarray(v) for v in values]
+        shape = np.broadcast_shapes(*[a.shape for a in arrays])
+        inputs, varying, order = _layout(arrays, shape)
+        n_rows = inputs[0].shape[0] if any(varying) else 1
+        row_size = int(np.prod(shape[1:])) if order is None else 1
+
+        # hoist invariant instructions; probe the others on one row
+        regs, info = self._probe(inputs, varying)
+        kind, index = self.result
+        if kind != 'reg' or index not in info:
+            value = (regs[index] if kind == 'reg'
+                     else inputs[index] if kind == 'leaf' else index)
+            return np.array(np.broadcast_to(value, shape))
+
+        dtype = info[index][0]
+        out = np.empty(shape, dtype=dtype, order=order or 'C')
+        flat = out.ravel(order) if order else out
+        if flat.size == 0:
+            return out
+        specs, slots = self._allocate(info)
+
+        step = min(max(1, block_bytes // (8 * row_size)), n_rows)
+        blocks = [(a, min(a + step, n_rows)) for a in range(0, n_rows, step)]
+        n_threads = min(n_threads or os.cpu_count(), len(blocks))
+        run = (lambda group: self._run(group, inputs, varying, regs,
+                                       specs, slots, step, flat))
+        if n_threads == 1:
+            run(blocks)
+        else:
+            groups = np.array_split(np.arange(len(blocks)), n_threads)
+            with ThreadPoolExecutor(n_threads) as pool:
+                list(pool.map(run, [[blocks[i] for i in g] for g in groups]))
+        return out
+
+    def _args(self, args, inputs, regs, rows=None, varying=None):
+        values = []
+        for kind, value in args:
+            if kind == 'leaf':
+                a = inputs[value]
+                values.append(a[rows] if rows is not None and varying[value]
+                              else a)
+            elif kind == 'reg':
+                values.append(regs[value])
+            else:
+                values.append(value)
+        return values
+
+    def _probe(self, inputs, varying):
+        """Hoisted values of invariant registers; dtype/shape of the rest"""
+        regs = [None] * len(self.instructions)
+        info = {}
+        probe = slice(0, 1)
+        for j, (func, args) in enumerate(self.instructions):
+            invariant = all(
+                (kind == 'leaf' and not varying[value])
+                or (kind == 'reg' and value not in info) or kind == 'const'
+                for kind, value in args)
+            values = self._args(args, inputs, regs, probe, varying)
+            result = (np.where(*values) if func == 'where'
+                      else func(*values))
+            regs[j] = result
+            if not invariant:
+                info[j] = (result.dtype, result.shape[1:])
+        # hoisted registers keep their values, probed ones are recomputed
+        return [regs[j] if j not in info else None
+                for j in range(len(regs))], info
+
+    def _allocate(self, info):
+        """Map each varying register to a scratch slot, reusing dead ones"""
+        last = self.result[1]
+        free, slots, specs = [], {}, []
+        for j, (func, args) in enumerate(self.instructions):
+            if j not in info:
+                continue
+            # an instruction may write over its own dead arguments
+            free.extend({slots[value] for kind, value in args
+                         if kind == 'reg' and value in slots
+                         and self.last_use[value] == j})
+            if j != last:
+                match = [s for s in free if specs[s] == info[j]]
+                if match:
+                    free.remove(match[0])
+                    slots[j] = match[0]
+                else:
+                    slots[j] = len(specs)
+                    specs.append(info[j])
+        return specs, slots
+
+    def _run(self, blocks, inputs, varying, hoisted, specs, slots, step,
+             out):
+        buffers = [np.empty((step,) + shape, dtype) for dtype, shape in specs]
+        last = self.result[1]
+        for start, stop in blocks:
+            rows = slice(start, stop)
+            regs = list(hoisted)
+            for j, (func, args) in enumerate(self.instructions):
+                if regs[j] is not None:
+                    continue
+                dest = (out[rows] if j == last
+                        else buffers[slots[j]][:stop - start])
+                values = self._args(args, inputs, regs, rows, varying)
+                if func == 'where':
+                    # faster than a masked copyto; the temporary is a block
+                    dest[...] = np.where(*values)
+                else:
+                    func(*values, out=dest)
+                regs[j] = dest
+
+
+def _layout(arrays, shape):
+    """Inputs arranged for blocking along their first axis
+
+    When every operand either has the full shape or is a single value,
+    and the full-shape ones share a memory order, they are flattened
+    (without copying) and blocked as 1-D; otherwise blocks are rows.
+    Returns ``(inputs, varying, order)``; `order` is None for rows.
+    """
+    full = [a.shape == shape for a in arrays]
+    if all(f or a.size == 1 for a, f in zip(arrays, full)):
+        for order, flag in [('C', 'C_CONTIGUOUS'), ('F', 'F_CONTIGUOUS')]:
+            if all(a.flags[flag] for a, f in zip(arrays, full) if f):
+                inputs = [a.ravel(order) if f else a.reshape(())
+                          for a, f in zip(arrays, full)]
+                return inputs, full, order
+    ndim = len(shape)
+    inputs = [a.reshape((1,) * (ndim - a.ndim) + a.shape) for a in arrays]
+    varying = [a.shape[0] == shape[0] for a in inputs]
+    return inputs, varying, None
+
+
+class _Compiler(ast.NodeVisitor):
+
+    def __init__(self):
+        self.leaves = []
+        self.instructions = []
+
+    def emit(self, func, args):
+        self.instructions.append((func, args))
+        return ('reg', len(self.instructions) - 1)
+
+    def leaf(self, node):
+        source = ast.unparse(node)
+        if source not in self.leaves:
+            self.leaves.append(source)
+        return ('leaf', self.leaves.index(source))
+
+    visit_Name = visit_Attribute = visit_Subscript = leaf
+
+    def visit_Constant(self, node):
+        if not isinstance(node.value, (bool, int, float, complex, str)):
+            raise ValueError('unsupported constant %r' % (node.value,))
+        return ('const', node.value)
+
+    def visit_BinOp(self, node):
+        try:
+            func = _BINOPS[type(node.op)]
+        except KeyError:
+            raise ValueError('unsupported operator %s'
+                             % type(node.op).__name__)
+        return self.emit(func, [self.visit(node.left),
+                                self.visit(node.right)])
+
+    def visit_UnaryOp(self, node):
+        return self.emit(_UNARYOPS[type(node.op)], [self.visit(node.operand)])
+
+    def visit_BoolOp(self, node):
+        func = _BOOLOPS[type(node.op)]
+        result = self.visit(node.values[0])
+        for value in node.values[1:]:
+            result = self.emit(func, [result, self.visit(value)])
+        return result
+
+    def visit_Compare(self, node):
+        # chained: a < b <= c  ->  (a < b) & (b <= c)
+        operands = [self.visit(node.left)]
+        operands += [self.visit(c) for c in node.comparators]
+        result = None
+        for op, left, right in zip(node.ops, operands, operands[1:]):
+            if type(op) not in _COMPARISONS:
+                raise ValueError('unsupported comparison %s'
+                                 % type(op).__name__)
+            step = self.emit(_COMPARISONS[type(op)], [left, right])
+            result = step if result is None else self.emit(
+                np.logical_and, [result, step])
+        return result
+
+    def visit_Call(self, node):
+        name = getattr(node.func, 'id', None)
+        if name not in FUNCTIONS or node.keywords:
+            raise ValueError('unsupported function call %s'
+                             % ast.unparse(node))
+        return self.emit(FUNCTIONS[name], [self.visit(a) for a in node.args])
+
+    def generic_visit(self, node):
+        raise ValueError('unsupported syntax %s' % type(node).__name__)
+
+
+def parse(text):
+    """The single statement of `text`, with ``@name`` made valid Python"""
+    tree = ast.parse(_LOCAL_RE.sub(_LOCAL_PREFIX + r'\1', text.strip()))
+    if len(tree.body) != 1:
+        raise ValueError('expected a single expression: %r' % text)
+    return tree.body[0]
+
+
+@lru_cache(maxsize=256)
+def compile_expression(text):
+    """Parse `text` into a `Plan` (cached by text)"""
+    statement = parse(text)
+    target = None
+    if isinstance(statement, ast.Assign):
+        if (len(statement.targets) != 1
+                or not isinstance(statement.targets[0], ast.Name)):
+            raise ValueError('only `name = expression` assignments are '
+                             'supported')
+        target = statement.targets[0].id
+    elif not isinstance(statement, ast.Expr):
+        raise ValueError('expected an expression: %r' % text)
+    compiler = _Compiler()
+    result = compiler.visit(statement.value)
+    return Plan(text, target, compiler.leaves, compiler.instructions, result)
+
+
+class _Namespace(dict):
+    """Name lookup: ``@name`` locals, then columns of `df`, then scope"""
+
+    def __init__(self, df, local_dict, global_dict):
+        super().__init__()
+        self.df = df
+        self.local_dict = local_dict
+        self.global_dict = global_dict
+
+    def __missing__(self, key):
+        if key.startswith(_LOCAL_PREFIX):
+            key = key[len(_LOCAL_PREFIX):]
+            if key in self.local_dict:
+                return self.local_dict[key]
+            return self.global_dict[key]
+        if self.df is not None and key in self.df.columns:
+            return self.df[key]
+        if key in self.local_dict:
+            return self.local_dict[key]
+        if key in self.global_dict:
+            return self.global_dict[key]
+        raise NameError('name %r is not defined' % key)
+
+
+def resolve(plan, df=None, local_dict=None, global_dict=None):
+    """Values of the leaves of `plan`, looked up as `fused_eval` does"""
+    namespace = _Namespace(df, local_dict or {}, global_dict or {})
+    return [eval(source, {'__builtins__': {}}, namespace)
+            for source in plan.leaves]
+
+
+def fused_eval(expr, df=None, local_dict=None, global_dict=None,
+               inplace=False, n_threads=None, block_bytes=BLOCK_BYTES,
+               level=0):
+    """Evaluate `expr` with a cached, blocked and threaded plan
+
+    Without `local_dict` / `global_dict`, names are looked up in the
+    caller's scope (`level` frames further up).  With an assignment and
+    `df`, returns a copy of `df` with the new column, or modifies `df` if
+    `inplace`.
+    """
+    plan = compile_expression(expr)
+    if local_dict is None and global_dict is None:
+        frame = sys._getframe(level + 1)
+        local_dict, global_dict = frame.f_locals, frame.f_globals
+    values = resolve(plan, df, local_dict, global_dict)
+    result = plan.evaluate(values, n_threads, block_bytes)
+
+    template = next((v for v in values
+                     if isinstance(v, (pd.DataFrame, pd.Series))
+                     and v.shape == result.shape), None)
+    if isinstance(template, pd.DataFrame):
+        result = pd.DataFrame(result, index=template.index,
+                              columns=template.columns, copy=False)
+    elif isinstance(template, pd.Series):
+        result = pd.Series(result, index=template.index,
+                           name=template.name, copy=False)
+
+    if plan.target is None:
+        return result
+    if df is None:
+        raise ValueError('assignment needs a DataFrame `df`')
+    if not inplace:
+        df = df.copy()
+    df[plan.target] = result
+    return None if inplace else df
+
+
+if __name__ == '__main__':
+    import tracemalloc
+    from timeit import repeat
+
+    rng = np.random.default_rng(42)
+    nrows, ncols = 100000, 100
+    df1, df2, df3, df4, df5 = (pd.DataFrame(rng.random((nrows, ncols)))
+                               for i in range(5))
+    a1, a2, a3, a4, a5 = (df.to_numpy() for df in (df1, df2, df3, df4, df5))
+
+    def best(stmt):
+        return min(repeat(stmt, number=1, repeat=3, globals=globals()))
+
+    def peak(stmt):
+        """Peak memory allocated while running `stmt`, in MB"""
+        tracemalloc.start()
+        eval(stmt)
+        usage = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return usage / 1e6
+
+    cases = [
+        ('df1 + df2 + df3 + df4', 'a1 + a2 + a3 + a4'),
+        ('-df1 * df2 / (df3 + df4) - df5', '-a1 * a2 / (a3 + a4) - a5'),
+        ('(df1 < 0.5) & (df2 < 0.5) | (df3 < df4)',
+         '(a1 < 0.5) & (a2 < 0.5) | (a3 < a4)'),
+        ('where(df1 > 0.5, sqrt(df2) * df3, -df4)',
+         'np.where(a1 > 0.5, np.sqrt(a2) * a3, -a4)'),
+    ]
+    print('%d x %d frames, %d threads; time (peak MB allocated)'
+          % (nrows, ncols, os.cpu_count()))
+    print('%-42s %13s %8s %13s' % ('expression', 'numpy', 'pd.eval',
+                                   'fused'))
+    for expr, numpy_expr in cases:
+        fused = 'fused_eval(%r)' % expr
+        assert np.allclose(eval(fused), eval(numpy_expr))
+        try:
+            pandas = '%6.0fms' % (1000 * best('pd.eval(%r)' % expr))
+        except Exception:                   # function calls
+            pandas = 'n/a'
+        print('%-42s %4.0fms (%4.0f) %8s %4.0fms (%4.0f)'
+              % (expr, 1000 * best(numpy_expr), peak(numpy_expr), pandas,
+                 1000 * best(fused), peak(fused)))
@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+"""Run groupby filter / transform / apply callbacks on all groups at once
+
+03_08_aggregation_and_grouping.py passes Python callbacks to `groupby`:
+
+    def filter_func(x):
+        return x['data2'].std() > 4
+
+    def center(x):
+        return x - x.mean()
+
+    def norm_by_data2(x):
+        x['data1'] /= x['data2'].sum()
+        return x
+
+and pandas calls them once per group, which dominates the run time when
+there are millions of small groups.  `GroupUDF` calls such a callback
+only once, on a stand-in for the group that represents every group at
+the same time:
+
+* the rows are sorted by group code once, so each group is a segment of
+  every column,
+* ``x['col']``, ``x.col`` and arithmetic / comparisons act on whole
+  sorted columns; reductions (`sum`, `mean`, `var`, `std`, `min`, `max`,
+  `count`) become `np.add.reduceat`-style segment kernels giving one
+  value per group, broadcast back to the rows where combined with them,
+* assignments (``x['data1'] /= ...``) replace the stand-in's column.
+
+If the callback does anything else (a Python `if` on a group value,
+`len(x)`, NumPy functions, other methods, non-numeric columns), the call
+falls back to the usual ``df.groupby(by).filter/transform/apply``; so does
+a frame with missing keys.  Callbacks with side effects run once more in
+that case.  Decisions are logged (logger ``group_udf``, level INFO).
+
+    groups = GroupUDF(df, 'key')
+    groups.filter(filter_func)
+    groups.transform(center)
+    groups.apply(norm_by_data2)
+"""
+
+import logging
+import operator
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger('group_udf')
+
+
+class _Unsupported(Exception):
+    """The callback does something the segment kernels do not cover"""
+
+
+class _Segments:
+    """Rows sorted by group code: the order, and each group's segment"""
+
+    def __init__(self, codes, n_groups):
+        self.order = np.argsort(codes, kind='stable')
+        self.counts = np.bincount(codes, minlength=n_groups)
+        self.starts = np.concatenate([[0], np.cumsum(self.counts)[:-1]])
+
+    def broadcast(self, values):
+        return np.repeat(values, self.counts)
+
+    def reduce(self, values, how, ddof=1):
+        """One value per group of the sorted `values`; NaN is skipped"""
+        starts = self.starts
+        if values.dtype.kind not in 'biuf':
+            raise _Unsupported('%s of %s values' % (how, values.dtype))
+        if values.dtype.kind != 'f':
+            if how in ('sum', 'min', 'max'):
+                ufunc = {'sum': np.add, 'min': np.minimum,
+                         'max': np.maximum}[how]
+                return ufunc.reduceat(values, starts)
+            if how == 'count':
+                return self.counts.copy()
+            values = values.astype(np.float64)
+        valid = ~np.isnan(values)
+        n = np.add.reduceat(valid, starts)
+        if how == 'count':
+            return n
+        if how in ('min', 'max'):
+            fill, ufunc = ((np.inf, np.minimum) if how == 'min'
+                           else (-np.inf, np.maximum))
+            result = ufunc.reduceat(np.where(valid, values, fill), starts)
+            return np.where(n > 0, result, np.nan)
+        total = np.add.reduceat(np.where(valid, values, 0), starts)
+        if how == 'sum':
+            return total
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = total / n
+            if how == 'mean':
+                return mean
+            deviations = np.where(valid, values - self.broadcast(mean), 0)
+            var = np.add.reduceat(deviations * deviations, starts) \
+                / (n - ddof)
+        var = np.where(n > ddof, var, np.nan)
+        return np.sqrt(var) if how == 'std' else var
+
+
+def _reduction(how):
+    def reduce(self, ddof=1):
+        if self.level != 'rows':
+            raise _Unsupported('%s of a reduced value' % how)
+        return self._map(lambda v: self.segments.reduce(v, how, ddof),
+                         level='groups')
+    reduce.__name__ = how
+    return reduce
+
+
+def _binary(op, reflected=False):
+    def method(self, other):
+        return self._combine(other, op, reflected)
+    return method
+
+
+class _Values:
+    """Stand-in for a group: a frame (`data` a dict of columns) or a
+    series, at the level of rows (sorted by group) or of groups"""
+
+    __array_ufunc__ = None                 # np.* on it: fall back
+
+    def __init__(self, data, level, segments, name=None):
+        self.data = data
+        self.level = level
+        self.segments = segments
+        self.name = name
+
+    @property
+    def is_frame(self):
+        return isinstance(self.data, dict)
+
+    def _map(self, func, level=None):
+        data = ({c: func(v) for c, v in self.data.items()} if self.is_frame
+                else func(self.data))
+        return _Values(data, level or self.level, self.segments, self.name)
+
+    def _rows(self, values):
+        return (self.segments.broadcast(values) if self.level == 'groups'
+                else values)
+
+    def _combine(self, other, op, reflected):
+        if isinstance(other, (bool, int, float, np.number)):
+            func = ((lambda v: op(other, v)) if reflected
+                    else (lambda v: op(v, other)))
+            return self._map(func)
+        if not isinstance(other, _Values) or other.is_frame != self.is_frame:
+            raise _Unsupported('operand %r' % type(other).__name__)
+        left, right = (other, self) if reflected else (self, other)
+        level = 'rows' if 'rows' in (left.level, right.level) else 'groups'
+        if level == 'rows':
+            left_data = (left._map(left._rows).data if left.level != level
+                         else left.data)
+            right_data = (right._map(right._rows).data
+                          if right.level != level else right.data)
+        else:
+            left_data, right_data = left.data, right.data
+        if not self.is_frame:
+            name = left.name if left.name == right.name else None
+            return _Values(op(left_data, right_data), level, self.segments,
+                           name)
+        if list(left_data) != list(right_data):
+            raise _Unsupported('frames with different columns')
+        return _Values({c: op(left_data[c], right_data[c])
+                        for c in left_data}, level, self.segments)
+
+    def __getitem__(self, key):
+        if not self.is_frame or self.level != 'rows':
+            raise _Unsupported('indexing a series')
+        if isinstance(key, list) and all(k in self.data for k in key):
+            return _Values({k: self.data[k] for k in key}, self.level,
+                           self.segments)
+        if isinstance(key, str) and key in self.data:
+            return _Values(self.data[key], self.level, self.segments, key)
+        raise _Unsupported('x[%r]' % (key,))
+
+    def __getattr__(self, name):
+        data = self.__dict__.get('data')
+        if isinstance(data, dict) and name in data:
+            return self[name]
+        raise _Unsupported('x.%s' % name)
+
+    def __setitem__(self, key, value):
+        if not self.is_frame or self.level != 'rows' \
+                or not isinstance(key, str):
+            raise _Unsupported('assigning x[%r]' % (key,))
+        if isinstance(value, _Values) and not value.is_frame:
+            self.data[key] = value._rows(value.data)
+        elif isinstance(value, (bool, int, float, np.number)):
+            self.data[key] = np.full(self.segments.counts.sum(), value)
+        else:
+            raise _Unsupported('assigning %r' % type(value).__name__)
+
+    def __bool__(self):
+        raise _Unsupported('truth value of a group value')
+
+    def __len__(self):
+        raise _Unsupported('len() of a group')
+
+    def __iter__(self):
+        raise _Unsupported('iterating over a group')
+
+    def __neg__(self):
+        return self._map(operator.neg)
+
+    def __abs__(self):
+        return self._map(np.abs)
+
+    sum = _reduction('sum')
+    mean = _reduction('mean')
+    var = _reduction('var')
+    std = _reduction('std')
+    min = _reduction('min')
+    max = _reduction('max')
+    count = _reduction('count')
+
+    __add__, __radd__ = _binary(operator.add), _binary(operator.add, True)
+    __sub__, __rsub__ = _binary(operator.sub), _binary(operator.sub, True)
+    __mul__, __rmul__ = _binary(operator.mul), _binary(operator.mul, True)
+    __truediv__ = _binary(operator.truediv)
+    __rtruediv__ = _binary(operator.truediv, True)
+    __pow__, __rpow__ = _binary(operator.pow), _binary(operator.pow, True)
+    __and__, __rand__ = _binary(operator.and_), _binary(operator.and_, True)
+    __or__, __ror__ = _binary(operator.or_), _binary(operator.or_, True)
+    __lt__, __le__ = _binary(operator.lt), _binary(operator.le)
+    __gt__, __ge__ = _binary(operator.gt), _binary(operator.ge)
+    __eq__, __ne__ = _binary(operator.eq), _binary(operator.ne)
+    __hash__ = None
+
+
+class GroupUDF:
+    """``df.groupby(by)`` whose callbacks run as segment operations
+
+    Groups are sorted by key (or kept in order of appearance with
+    ``sort=False``), as with `groupby`.  `last_path` tells whether the
+    last call ran as 'segments' or fell back to 'groupby'.
+    """
+
+    def __init__(self, df, by, sort=True):
+        self.df = df
+        self.by = by
+        self.sort = sort
+        by = [by] if isinstance(by, str) else list(by)
+        self.columns = [c for c in df.columns if c not in by]
+        if len(by) == 1:
+            codes, keys = pd.factorize(df[by[0]], sort=sort)
+            self.keys = pd.Index(keys, name=by[0])
+        else:
+            codes, keys = pd.factorize(pd.MultiIndex.from_frame(df[by]),
+                                       sort=sort)
+            self.keys = pd.MultiIndex.from_tuples(keys, names=by)
+        self.codes = codes
+        self._segments = None
+        self.last_path = None
+
+    @property
+    def segments(self):
+        if self._segments is None:
+            self._segments = _Segments(self.codes, len(self.keys))
+        return self._segments
+
+    def _trace(self, func):
+        """`func` on a stand-in for all groups, or None if not possible"""
+        if (self.codes < 0).any():
+            logger.info('missing keys: using groupby')
+            return None
+        if any(self.df[c].dtype.kind not in 'biuf' for c in self.columns):
+            logger.info('non-numeric columns: using groupby')
+            return None
+        order = self.segments.order
+        x = _Values({c: self.df[c].to_numpy()[order] for c in self.columns},
+                    'rows', self.segments)
+        try:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                result = func(x)
+        except Exception as error:
+            logger.info('%s: %s, using groupby',
+                        getattr(func, '__name__', func), error)
+            return None
+        if not isinstance(result, _Values):
+            return None
+        return result
+
+    def _unsorted(self, values):
+        """Row values in sorted-by-group order -> the frame's row order"""
+        out = np.empty_like(values)
+        out[self.segments.order] = values
+        return out
+
+    def _fallback(self, how, func):
+        self.last_path = 'groupby'
+        grouped = self.df.groupby(self.by, sort=self.sort)
+        return getattr(grouped, how)(func)
+
+    def filter(self, func):
+        """Rows of the groups for which ``func(group)`` is True"""
+        result = self._trace(func)
+        if result is None or result.level != 'groups' or result.is_frame \
+                or result.data.dtype != bool:
+            return self._fallback('filter', func)
+        self.last_path = 'segments'
+        keep = self._unsorted(self.segments.broadcast(result.data))
+        return self.df[keep]
+
+    def transform(self, func):
+        """``func(group)`` broadcast to the rows of each group"""
+        result = self._trace(func)
+        if result is None:
+            return self._fallback('transform', func)
+        self.last_path = 'segments'
+        rows = result._map(result._rows, level='rows')
+        if rows.is_frame:
+            return pd.DataFrame({c: self._unsorted(v)
+                                 for c, v in rows.data.items()},
+                                index=self.df.index)
+        return pd.Series(self._unsorted(rows.data), index=self.df.index,
+                         name=rows.name)
+
+    def apply(self, func):
+        """``func(group)`` per group, combined as `groupby.apply` does
+
+        A reduced value gives one row per group key; rows give the group
+        key prepended to the row labels, in group order.
+        """
+        result = self._trace(func)
+        if result is None:
+            return self._fallback('apply', func)
+        self.last_path = 'segments'
+        if result.level == 'groups':
+            if result.is_frame:
+                return pd.DataFrame(result.data, index=self.keys)
+            return pd.Series(result.data, index=self.keys)
+        keys = self.keys.repeat(self.segments.counts)
+        index = pd.MultiIndex.from_arrays(
+            [keys.get_level_values(i) for i in range(keys.nlevels)]
+            + [self.df.index[self.segments.order]],
+            names=list(self.keys.names) + [self.df.index.name])
+        if result.is_frame:
+            return pd.DataFrame(result.data, index=index)
+        return pd.Series(result.data, index=index, name=result.name)
+
+
+if __name__ == '__main__':
+    import sys
+    from timeit import timeit
+
+    def filter_func(x):
+        return x['data2'].std() > 4
+
+    def center(x):
+        return x - x.mean()
+
+    def norm_by_data2(x):
+        # x is a DataFrame of group values
+        x['data1'] /= x['data2'].sum()
+        return x
+
+    def top_row(x):
+        return x.sort_values('data2').head(1)
+
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame({'key': ['A', 'B', 'C', 'A', 'B', 'C'],
+                       'data1': range(6),
+                       'data2': rng.randint(0, 10, 6)},
+                      columns=['key', 'data1', 'data2'])
+    groups = GroupUDF(df, 'key')
+    grouped = df.groupby('key')
+    for how, func in [('filter', filter_func), ('transform', center),
+                      ('apply', norm_by_data2), ('apply', top_row),
+                      ('apply', lambda x: x['data1'].mean()),
+                      ('apply', lambda x: x.mean())]:
+        result = getattr(groups, how)(func)
+        expected = getattr(grouped, how)(func)
+        assert result.equals(expected), (how, func)
+        assert groups.last_path == ('groupby' if func is top_row
+                                    else 'segments')
+
+    n_groups = int(float(sys.argv[1])) if len(sys.argv) > 1 else 200000
+    n = 3 * n_groups
+    big = pd.DataFrame({'key': rng.randint(0, n_groups, n),
+                        'data1': rng.randint(0, 10, n).astype(float),
+                        'data2': rng.randint(0, 10, n)})
+    groups, grouped = GroupUDF(big, 'key'), big.groupby('key')
+    print('%d rows in %d groups' % (n, big['key'].nunique()))
+    for how, func in [('filter', filter_func), ('transform', center),
+                      ('apply', norm_by_data2)]:
+        t_segments = timeit(lambda: getattr(GroupUDF(big, 'key'), how)(func),
+                            number=1)
+        t_groupby = timeit(lambda: getattr(grouped, how)(func), number=1)
+        result = getattr(groups, how)(func)
+        expected = getattr(grouped, how)(func)
+        assert result.index.equals(expected.index)
+        assert np.allclose(result.to_numpy(dtype=float),
+                           expected.to_numpy(dtype=float), equal_nan=True)
+        print('%-9s %-14s groupby %7.2fs, segments %6.3fs'
+              % (how, func.__name__, t_groupby, t_segments))
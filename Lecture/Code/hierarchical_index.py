@@ -0,0 +1,438 @@
+# -*- coding: utf-8 -*-
+"""Binary-search lookups on sorted hierarchical (MultiIndex) sales frames
+
+Lecture10_Scripts3.ipynb indexes sample_data2.csv by three levels and
+selects with `.loc`:
+
+    df_ind_sorted = df.set_index(['Country', 'Type', 'Product']).sort_index()
+    df_ind_sorted.loc['Bangladesh', 'Government', 'Pen']
+    df_ind_sorted.loc[idx['Bangladesh', ['Government', 'Private']], :]
+    df_ind_sorted.loc[(slice(None), ['Government'], slice(None)), :]
+
+`HierarchicalIndex` answers the same selections from a compact copy of
+the index:
+
+* every level is encoded as integer codes in sorted label order (missing
+  labels last, as `sort_index` puts them),
+* the code tuple of each row is packed into one unsigned integer, the
+  level-0 code in the high bits, in the smallest dtype that holds it
+  (``uint16`` for 200 countries x 2 types x 50 products), so lexsorted
+  tuples are just sorted integers,
+* a key fixing the first k levels is one contiguous run of keys, found by
+  two `searchsorted` calls; a free level followed by a fixed one (the
+  `slice(None)` above) expands into the runs of the distinct prefixes
+  present, and the fixed level is searched in each of them at once,
+* results are row positions, or a zero-copy `iloc` slice of the frame
+  when the selection is a single run,
+* the notebook's ``for idx, data in df_ind_sorted.groupby(level=0)``
+  loops (then level=1, level=2) each rebuild the groups and copy every
+  sub-frame; the run boundaries of all levels come from one comparison
+  pass over the keys instead, and `groups` yields each group's key tuple
+  with a slice of the sorted frame (a view) when grouping by leading
+  levels; `apply` runs a function per group in a thread pool.
+
+It is exposed as the ``hindex`` DataFrame accessor.  The engine is built
+on first use and kept for as long as the frame's index object lives
+(`set_index`, `sort_index`, ... make a new one).
+
+    df_ind_sorted.hindex['Bangladesh', 'Government', 'Pen']
+    df_ind_sorted.hindex[idx['Bangladesh', ['Government', 'Private']], :]
+    df_ind_sorted.hindex.positions((slice(None), ['Government']))
+    for key, data in df_ind_sorted.hindex.groups(level=0):
+        print(key, data)
+"""
+
+import os
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# engines by id() of their index; pandas creates a new accessor object on
+# every ``df.hindex``, and indexes are immutable but unhashable
+_ENGINES = {}
+
+
+def _level_codes(index, i):
+    """``(codes, labels)`` of level `i`, codes in sorted label order
+
+    Missing labels get the code ``len(labels)``.
+    """
+    if isinstance(index, pd.MultiIndex):
+        labels, codes = index.levels[i], np.asarray(index.codes[i])
+        order = labels.argsort()
+        rank = np.empty(len(labels) + 1, dtype=np.int64)
+        rank[order] = np.arange(len(labels))
+        rank[-1] = len(labels)                  # code -1: missing
+        return rank[codes], labels[order]
+    codes, labels = pd.factorize(index, sort=True)
+    codes = np.where(codes < 0, len(labels), codes)
+    return codes, pd.Index(labels)
+
+
+def _aranges(starts, stops):
+    """Concatenation of ``arange(start, stop)`` for each pair"""
+    lengths = stops - starts
+    total = int(lengths.sum())
+    if not total:
+        return np.empty(0, dtype=np.int64)
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return np.arange(total) + offsets
+
+
+class HierarchicalIndex:
+    """Lexsorted, packed integer keys of a (Multi)Index"""
+
+    def __init__(self, index):
+        self.names = list(index.names)
+        self.labels = []
+        bits = []
+        codes = []
+        for i in range(index.nlevels):
+            level_codes, labels = _level_codes(index, i)
+            self.labels.append(labels)
+            codes.append(level_codes)
+            bits.append(max(int(len(labels)).bit_length(), 1))
+        if sum(bits) > 63:
+            raise ValueError('%d bits of codes do not fit in a 64-bit key'
+                             % sum(bits))
+        self.bits = bits
+        self.lookup = [{label: code for code, label in enumerate(labels)}
+                       for labels in self.labels]
+        # the bits below level i: shifts[i]
+        self.shifts = [sum(bits[i + 1:]) for i in range(len(bits))]
+        self.dtype = next(np.dtype(t) for t in ('u1', 'u2', 'u4', 'u8')
+                          if 8 * np.dtype(t).itemsize >= sum(bits))
+        keys = np.zeros(len(index), dtype=self.dtype)
+        for level_codes, shift in zip(codes, self.shifts):
+            keys |= level_codes.astype(self.dtype) << self.dtype.type(shift)
+        if len(keys) > 1 and (keys[1:] < keys[:-1]).any():
+            self.order = np.argsort(keys, kind='stable')
+            keys = keys[self.order]
+        else:
+            self.order = None               # the frame is sorted already
+        self.keys = keys
+        self._boundaries = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def is_sorted(self):
+        return self.order is None
+
+    def boundaries(self, depth):
+        """Start of each run of equal first-`depth` levels, then n"""
+        if depth not in self._boundaries:
+            self._find_boundaries()
+        return self._boundaries[depth]
+
+    def _find_boundaries(self):
+        # one pass over the keys finds every change; the highest differing
+        # bit of each tells the first level that changes there
+        keys, n = self.keys, len(self.keys)
+        changes = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+        differ = (keys[changes] ^ keys[changes - 1]).astype(np.uint64)
+        self._boundaries[0] = np.array([0, n]) if n else np.array([0])
+        for depth, shift in enumerate(self.shifts, 1):
+            at = changes[(differ >> np.uint64(shift)) > 0]
+            self._boundaries[depth] = np.concatenate(
+                [[0], at, [n]] if n else [[0]]).astype(np.int64)
+
+    def level_numbers(self, level):
+        """Sorted level numbers of a level (number or name) or list"""
+        levels = level if isinstance(level, (list, tuple)) else [level]
+        return sorted({self.names.index(lv) if lv in self.names else lv
+                       for lv in levels})
+
+    def label(self, level, code):
+        labels = self.labels[level]
+        return labels[code] if code < len(labels) else np.nan
+
+    def groups(self, level=0):
+        """Yield ``(key tuple, (starts, stops))`` per group, in key order
+
+        `level` is a level (number or name) or a list of them, as in
+        ``groupby(level=...)``.  When the levels are the first k, each
+        group is a single run of the sorted keys.
+        """
+        levels = self.level_numbers(level)
+        bounds = self.boundaries(levels[-1] + 1)
+        starts, stops = bounds[:-1], bounds[1:]
+        codes = [(self.keys[starts] >> self.dtype.type(self.shifts[lv]))
+                 & self.dtype.type((1 << self.bits[lv]) - 1)
+                 for lv in levels]
+        if levels != list(range(len(levels))):
+            # the runs of one group are not adjacent: bring them together
+            order = np.lexsort(codes[::-1])
+            starts, stops = starts[order], stops[order]
+            codes = [c[order] for c in codes]
+        group = np.concatenate([[0], np.flatnonzero(np.any(
+            [c[1:] != c[:-1] for c in codes], axis=0)) + 1, [len(starts)]]
+            if len(starts) else [[0]]).astype(np.int64)
+        for first, last in zip(group[:-1], group[1:]):
+            key = tuple(self.label(lv, int(c[first]))
+                        for lv, c in zip(levels, codes))
+            yield key, (starts[first:last], stops[first:last])
+
+    def codes(self, level, key):
+        """Sorted codes of level `level` selected by a label, list or slice
+
+        A missing label raises KeyError; in a list it is skipped.
+        """
+        labels = self.labels[level]
+        if isinstance(key, slice):
+            if key.step is not None:
+                raise ValueError('slices with a step are not supported')
+            start = (0 if key.start is None
+                     else labels.searchsorted(key.start, side='left'))
+            stop = (len(labels) if key.stop is None
+                    else labels.searchsorted(key.stop, side='right'))
+            return np.arange(start, max(start, stop))
+        lookup = self.lookup[level]
+        if pd.api.types.is_list_like(key):
+            return np.unique(np.array([lookup[k] for k in key if k in lookup],
+                                      dtype=np.int64))
+        if key not in lookup:
+            raise KeyError(key)
+        return np.array([lookup[key]])
+
+    def ranges(self, key):
+        """``(starts, stops)`` of the runs of sorted keys matching `key`
+
+        `key` is a label (first level) or a tuple with one entry per
+        leading level: a label, a list of labels, or a label slice
+        (``slice(None)``: all).
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > len(self.labels):
+            raise KeyError(key)
+        specs = [None if isinstance(k, slice) and k == slice(None)
+                 else self.codes(level, k) for level, k in enumerate(key)]
+        while specs and specs[-1] is None:
+            specs.pop()
+        starts = np.array([0])
+        stops = np.array([len(self.keys)])
+        prefixes = np.zeros(1, dtype=np.uint64)
+        for level, codes in enumerate(specs):
+            shift = np.uint64(self.shifts[level])
+            if codes is None:
+                # split the runs by the distinct values of this level
+                bounds = self.boundaries(level + 1)
+                runs = _aranges(np.searchsorted(bounds, starts),
+                                np.searchsorted(bounds, stops))
+                starts, stops = bounds[runs], bounds[runs + 1]
+                prefixes = self.keys[starts].astype(np.uint64) >> shift
+                continue
+            prefixes = ((prefixes[:, None] << np.uint64(self.bits[level]))
+                        | codes.astype(np.uint64)[None, :]).ravel()
+            low = (prefixes << shift).astype(self.dtype)
+            high = (((prefixes + np.uint64(1)) << shift)
+                    - np.uint64(1)).astype(self.dtype)
+            starts = np.searchsorted(self.keys, low, side='left')
+            stops = np.searchsorted(self.keys, high, side='right')
+            found = stops > starts
+            starts, stops, prefixes = (starts[found], stops[found],
+                                       prefixes[found])
+        # merge touching runs ('Bangladesh':'China' is one run)
+        if len(starts) > 1:
+            new = np.concatenate([[True], starts[1:] != stops[:-1]])
+            starts = starts[new]
+            stops = stops[np.concatenate([new[1:], [True]])]
+        return starts, stops
+
+    def count(self, key):
+        starts, stops = self.ranges(key)
+        return int((stops - starts).sum())
+
+    def positions(self, key):
+        """Ascending row positions (in the indexed frame) matching `key`"""
+        positions = _aranges(*self.ranges(key))
+        if self.order is not None:
+            positions = np.sort(self.order[positions])
+        return positions
+
+
+@pd.api.extensions.register_dataframe_accessor('hindex')
+class HierarchicalAccessor:
+    """``df.hindex[key]``: `.loc`-style row selection by binary search
+
+    `key` is as in `HierarchicalIndex.ranges`, or ``(key, columns)`` as
+    with ``.loc[idx[...], columns]``.  Rows keep their full index.
+    """
+
+    def __init__(self, df):
+        self._df = df
+
+    @property
+    def engine(self):
+        index = self._df.index
+        entry = _ENGINES.get(id(index))
+        if entry is None or entry[0]() is not index:
+            entry = (weakref.ref(index), HierarchicalIndex(index))
+            _ENGINES[id(index)] = entry
+            weakref.finalize(index, _ENGINES.pop, id(index), None)
+        return entry[1]
+
+    def positions(self, key):
+        return self.engine.positions(key)
+
+    def count(self, key):
+        return self.engine.count(key)
+
+    def _rows(self, starts, stops):
+        if self.engine.is_sorted and len(starts) == 1:
+            return self._df.iloc[starts[0]:stops[0]]        # a view
+        positions = _aranges(starts, stops)
+        if not self.engine.is_sorted:
+            positions = np.sort(self.engine.order[positions])
+        return self._df.iloc[positions]
+
+    def groups(self, level=0):
+        """``for key, data in df.hindex.groups(level)``, like `groupby`
+
+        Keys are always tuples.  Grouping by the first k levels of a
+        sorted frame yields slices (views) of it; other groups are
+        gathered rows.
+        """
+        for key, (starts, stops) in self.engine.groups(level):
+            yield key, self._rows(starts, stops)
+
+    def apply(self, func, level=0, n_jobs=None):
+        """``func(data)`` for every group, in `n_jobs` threads
+
+        Scalar results come back as a Series indexed by the group keys,
+        Series/DataFrame results concatenated with the keys prepended.
+        """
+        groups = list(self.engine.groups(level))
+        n_jobs = min(n_jobs or os.cpu_count(), max(len(groups), 1))
+        # one contiguous batch of groups per thread
+        batches = np.array_split(np.arange(len(groups)), n_jobs)
+
+        def run(batch):
+            return [func(self._rows(*groups[i][1])) for i in batch]
+
+        with ThreadPoolExecutor(n_jobs) as pool:
+            results = [r for part in pool.map(run, batches) for r in part]
+        names = [self.engine.names[lv]
+                 for lv in self.engine.level_numbers(level)]
+        keys = pd.MultiIndex.from_tuples([key for key, _ in groups],
+                                         names=names)
+        if results and isinstance(results[0], (pd.Series, pd.DataFrame)):
+            return pd.concat(results, keys=keys)
+        return pd.Series(results, index=keys)
+
+    def __getitem__(self, key):
+        columns = slice(None)
+        if isinstance(key, tuple) and len(key) == 2 \
+                and isinstance(key[0], tuple):
+            key, columns = key
+        engine = self.engine
+        starts, stops = engine.ranges(key)
+        if engine.is_sorted and len(starts) == 1:
+            rows = slice(starts[0], stops[0])
+        else:
+            rows = engine.positions(key)
+        if isinstance(columns, slice) and columns == slice(None):
+            return self._df.iloc[rows]
+        return self._df.iloc[rows].loc[:, columns]
+
+
+if __name__ == '__main__':
+    import sys
+    from timeit import timeit
+
+    idx = pd.IndexSlice
+    df = pd.read_csv('sample_data2.csv')
+    df_ind_sorted = df.set_index(['Country', 'Type', 'Product']).sort_index()
+    for key in [('Bangladesh', 'Government', 'Pen'),
+                ('Bangladesh', 'Government'), 'Bangladesh',
+                idx['Bangladesh', ['Government', 'Private']],
+                (slice(None), ['Government'], slice(None)),
+                slice('Bangladesh', 'China')]:
+        expected = df_ind_sorted.loc[key, :]
+        assert df_ind_sorted.hindex[key, :].equals(
+            df_ind_sorted.iloc[df_ind_sorted.index.get_locs(
+                key if isinstance(key, tuple) else (key,))]), key
+        assert df_ind_sorted.hindex.count(key) == len(expected), key
+    for frame in [df_ind_sorted, df_ind_sorted.sample(frac=1,
+                                                     random_state=0)]:
+        for level in [0, 1, 2, [0, 1], 'Product']:
+            for (key, data), (expected_key, expected) in zip(
+                    frame.hindex.groups(level), frame.groupby(level=level)):
+                if not isinstance(expected_key, tuple):
+                    expected_key = (expected_key,)
+                assert key == expected_key and data.equals(expected)
+    # an unsorted frame gives the same rows, in frame order
+    shuffled = df_ind_sorted.sample(frac=1, random_state=0)
+    assert shuffled.hindex[(slice(None), 'Private')].equals(
+        shuffled[shuffled.index.get_level_values('Type') == 'Private'])
+
+    # a large sorted frame: 200 countries x 2 types x 50 products
+    n = int(float(sys.argv[1])) if len(sys.argv) > 1 else 50000000
+    rng = np.random.default_rng(0)
+    countries = sorted(set(df['Country'])
+                       | {'Country %03d' % i for i in range(196)})
+    products = sorted(set(df['Product'])
+                      | {'Product %02d' % i for i in range(48)})
+    codes = [rng.integers(0, len(countries), n, dtype=np.int16),
+             rng.integers(0, 2, n, dtype=np.int8),
+             rng.integers(0, len(products), n, dtype=np.int8)]
+    order = np.lexsort(codes[::-1])
+    index = pd.MultiIndex(
+        levels=[countries, ['Government', 'Private'], products],
+        codes=[c[order] for c in codes], names=['Country', 'Type', 'Product'],
+        verify_integrity=False)
+    del codes, order
+    big = pd.DataFrame({'Items': rng.integers(1, 20, n),
+                        'Price': rng.integers(5, 25, n)}, index=index)
+
+    t_build = timeit(lambda: big.hindex.engine, number=1)
+    print('%d rows; keys: %s, %.0f MB, built in %.1fs'
+          % (n, big.hindex.engine.dtype, big.hindex.engine.keys.nbytes / 1e6,
+             t_build))
+    big.loc[('Bangladesh', 'Government', 'Pen'), :]    # pandas' own engine
+    print('%-36s %9s %9s %10s %9s'
+          % ('key', '.loc', 'hindex', 'positions', 'rows'))
+    for key in [('Bangladesh', 'Government', 'Pen'),
+                ('Bangladesh', 'Government'),
+                slice('Bangladesh', 'China'),
+                (slice(None), ['Government'], 'Pen'),
+                (slice(None), slice(None), ['Pen', 'Pencil'])]:
+        n_runs = 5
+        t_loc = timeit(lambda: big.loc[key, :], number=n_runs) / n_runs
+        t_ix = timeit(lambda: big.hindex[key, :], number=n_runs) / n_runs
+        t_pos = timeit(lambda: big.hindex.positions(key),
+                       number=n_runs) / n_runs
+        result = big.hindex[key, :]
+        assert len(result) == len(big.loc[key, :]), key
+        label = str(key).replace('slice(None, None, None)', ':')
+        print('%-36s %7.2fms %7.2fms %8.2fms %9d'
+              % (label[:36], 1000 * t_loc, 1000 * t_ix, 1000 * t_pos,
+                 len(result)))
+
+    def items_per_group(data):
+        return data['Items'].sum()
+
+    print('\nper-group loops (sum of Items):')
+    engine = big.hindex.engine
+    engine._boundaries.clear()
+    t_bounds = timeit(lambda: engine.boundaries(1), number=1)
+    print('boundaries of all %d levels: %.0fms'
+          % (len(engine.bits), 1000 * t_bounds))
+    for level in [0, 1, [0, 1, 2]]:
+        t_pandas = timeit(lambda: [items_per_group(data) for _, data
+                                   in big.groupby(level=level)], number=1)
+        t_groups = timeit(lambda: [items_per_group(data) for _, data
+                                   in big.hindex.groups(level)], number=1)
+        t_apply = timeit(lambda: big.hindex.apply(items_per_group, level),
+                         number=1)
+        expected = big.groupby(level=level)['Items'].sum().to_numpy()
+        assert np.array_equal(
+            big.hindex.apply(items_per_group, level).to_numpy(), expected)
+        print('level=%-10s groupby %7.0fms, groups %7.0fms, '
+              'apply (%d threads) %7.0fms'
+              % (level, 1000 * t_pandas, 1000 * t_groups, os.cpu_count(),
+                 1000 * t_apply))
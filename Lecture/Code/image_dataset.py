@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""Memory-mapped image datasets for the digits and LFW experiments
+
+Lecture18_Script5 loads `load_digits()` and the second assignment loads
+`fetch_lfw_people(min_faces_per_person=70)` fully into RAM as float64
+before GaussianNB or RandomForest sees a single row.  `ImageDataset` keeps
+the images on disk instead:
+
+* a dataset is a directory holding ``images.npy``, an ``(n, height, width)``
+  uint8 tensor opened with ``mmap_mode='r'``, and ``target.npy``,
+* `batches` produces flattened (and optionally scaled or standardized)
+  float32 feature blocks lazily, one batch at a time,
+* `train_test_split` returns index arrays rather than copies, and
+  `partial_fit` / `score` stream those indices through any estimator with
+  `partial_fit` (GaussianNB, MultinomialNB, SGDClassifier, ...).
+
+`make_synthetic_images` writes test sets of millions of 8x8 or 62x47
+images block by block, without ever holding them in memory.
+
+    data = ImageDataset.from_digits('digits_mm')
+    train, test = data.train_test_split(random_state=0)
+    model = data.partial_fit(GaussianNB(), train)
+    data.score(model, test)
+"""
+
+import os
+
+import numpy as np
+
+
+class ImageDataset:
+    """uint8 image tensor and labels, memory-mapped from `root`"""
+
+    def __init__(self, root):
+        self.root = root
+        self.images = np.load(os.path.join(root, 'images.npy'),
+                              mmap_mode='r')
+        self.target = np.load(os.path.join(root, 'target.npy'))
+        self._stats = None
+
+    def __len__(self):
+        return len(self.images)
+
+    @property
+    def n_features(self):
+        return int(np.prod(self.images.shape[1:]))
+
+    @classmethod
+    def create(cls, root, n_images, shape, target_dtype=np.int16):
+        """Allocate empty on-disk arrays; returns the writable memmaps
+
+        Pixel statistics cached for earlier images in `root` are removed.
+        """
+        os.makedirs(root, exist_ok=True)
+        stats_path = os.path.join(root, 'pixel_stats.npz')
+        if os.path.exists(stats_path):
+            os.remove(stats_path)
+        images = np.lib.format.open_memmap(os.path.join(root, 'images.npy'),
+                                           mode='w+', dtype=np.uint8,
+                                           shape=(n_images,) + tuple(shape))
+        target = np.lib.format.open_memmap(os.path.join(root, 'target.npy'),
+                                           mode='w+', dtype=target_dtype,
+                                           shape=(n_images,))
+        return images, target
+
+    @classmethod
+    def from_arrays(cls, root, images, target, max_value=None):
+        """Quantize float or integer images to uint8 and store them
+
+        Values are scaled so that `max_value` (default: the largest value
+        in `images`) maps to 255.
+        """
+        images = np.asarray(images)
+        max_value = max_value or images.max()
+        out, out_target = cls.create(root, len(images), images.shape[1:])
+        out[:] = np.clip(np.rint(images * (255. / max_value)), 0, 255)
+        out_target[:] = target
+        out.flush()
+        out_target.flush()
+        del out, out_target
+        return cls(root)
+
+    @classmethod
+    def from_digits(cls, root):
+        from sklearn.datasets import load_digits
+        digits = load_digits()
+        return cls.from_arrays(root, digits.images, digits.target,
+                               max_value=16)
+
+    @classmethod
+    def from_lfw(cls, root, **kwargs):
+        from sklearn.datasets import fetch_lfw_people
+        faces = fetch_lfw_people(**kwargs)
+        return cls.from_arrays(root, faces.images, faces.target)
+
+    def pixel_stats(self, batch_size=65536):
+        """Per-pixel mean and std over the whole set, computed blockwise
+
+        The result is cached in ``pixel_stats.npz`` together with the shape
+        of the images it was computed from, and recomputed when that shape
+        no longer matches.
+        """
+        if self._stats is None:
+            path = os.path.join(self.root, 'pixel_stats.npz')
+            if os.path.exists(path):
+                with np.load(path) as stats:
+                    if tuple(stats['shape']) == self.images.shape:
+                        self._stats = stats['mean'], stats['std']
+            if self._stats is None:
+                total = np.zeros(self.n_features)
+                total_sq = np.zeros(self.n_features)
+                for start in range(0, len(self), batch_size):
+                    block = self.images[start:start + batch_size]
+                    block = block.reshape(len(block), -1).astype(np.float64)
+                    total += block.sum(axis=0)
+                    total_sq += np.einsum('ij,ij->j', block, block)
+                mean = total / len(self)
+                std = np.sqrt(np.maximum(total_sq / len(self) - mean ** 2, 0))
+                std[std == 0] = 1
+                np.savez(path, mean=mean, std=std,
+                         shape=np.array(self.images.shape))
+                self._stats = mean, std
+        return self._stats
+
+    def features(self, index, normalize='scale', dtype=np.float32):
+        """Flattened feature rows for `index` (a slice or index array)
+
+        `normalize` is None (raw 0..255 values), 'scale' (divide by 255) or
+        'standardize' (per-pixel zero mean, unit variance).
+        """
+        block = self.images[index]
+        X = block.reshape(len(block), -1).astype(dtype)
+        if normalize == 'scale':
+            X *= np.dtype(dtype).type(1. / 255)
+        elif normalize == 'standardize':
+            mean, std = self.pixel_stats()
+            X -= mean.astype(dtype)
+            X /= std.astype(dtype)
+        elif normalize is not None:
+            raise ValueError("normalize must be None, 'scale' or "
+                             "'standardize', got %r" % (normalize,))
+        return X
+
+    def batches(self, batch_size=4096, indices=None, shuffle=False,
+                random_state=None, **feature_kwargs):
+        """Yield ``(X, y)`` batches over `indices` (default: all images)
+
+        Without `indices` and `shuffle` the batches are contiguous slices of
+        the memory map, the fastest access pattern.
+        """
+        if indices is None and not shuffle:
+            for start in range(0, len(self), batch_size):
+                index = slice(start, start + batch_size)
+                yield self.features(index, **feature_kwargs), \
+                    self.target[index]
+            return
+
+        indices = np.arange(len(self)) if indices is None else indices
+        if shuffle:
+            indices = np.random.RandomState(random_state).permutation(indices)
+        for start in range(0, len(indices), batch_size):
+            # sorted reads are much kinder to the page cache
+            index = np.sort(indices[start:start + batch_size])
+            yield self.features(index, **feature_kwargs), self.target[index]
+
+    def train_test_split(self, test_size=0.25, random_state=None):
+        """Index arrays of a random train/test split"""
+        order = np.random.RandomState(random_state).permutation(len(self))
+        n_test = int(np.ceil(test_size * len(self)))
+        return np.sort(order[n_test:]), np.sort(order[:n_test])
+
+    def partial_fit(self, model, indices=None, batch_size=4096, n_epochs=1,
+                    shuffle=True, random_state=None, **feature_kwargs):
+        """Train `model` with `partial_fit`, one batch at a time"""
+        classes = np.unique(self.target)
+        rng = np.random.RandomState(random_state)
+        for _ in range(n_epochs):
+            for X, y in self.batches(batch_size, indices, shuffle,
+                                     rng.randint(2 ** 31), **feature_kwargs):
+                model.partial_fit(X, y, classes=classes)
+        return model
+
+    def predict(self, model, indices=None, batch_size=4096, **feature_kwargs):
+        return np.concatenate([
+            model.predict(X) for X, _ in
+            self.batches(batch_size, indices, **feature_kwargs)])
+
+    def score(self, model, indices=None, batch_size=4096, **feature_kwargs):
+        """Accuracy of `model` over `indices`"""
+        correct = total = 0
+        for X, y in self.batches(batch_size, indices, **feature_kwargs):
+            correct += np.sum(model.predict(X) == y)
+            total += len(y)
+        return correct / total
+
+
+def make_synthetic_images(root, n_images, shape=(8, 8), n_classes=10,
+                          noise=120, block_size=100000, random_state=0):
+    """Write `n_images` noisy copies of `n_classes` random smooth prototypes
+
+    Works for digit-sized (8, 8) and face-sized (62, 47) images alike;
+    memory use is bounded by `block_size`.
+    """
+    rng = np.random.RandomState(random_state)
+    # smooth prototypes: low-resolution random patterns, upsampled
+    coarse = rng.rand(n_classes, 4, 4) * 255
+    rows = np.linspace(0, 3, shape[0]).round().astype(int)
+    cols = np.linspace(0, 3, shape[1]).round().astype(int)
+    prototypes = coarse[:, rows][:, :, cols]
+
+    images, target = ImageDataset.create(root, n_images, shape)
+    for start in range(0, n_images, block_size):
+        stop = min(start + block_size, n_images)
+        labels = rng.randint(0, n_classes, stop - start)
+        block = prototypes[labels] + noise * rng.randn(stop - start, *shape)
+        images[start:stop] = np.clip(block, 0, 255)
+        target[start:stop] = labels
+    images.flush()
+    target.flush()
+    del images, target
+    return ImageDataset(root)
+
+
+if __name__ == '__main__':
+    import sys
+    import tempfile
+    from time import perf_counter
+    from sklearn.naive_bayes import GaussianNB
+
+    n_images = int(float(sys.argv[1])) if len(sys.argv) > 1 else 2000000
+    work_dir = tempfile.mkdtemp()
+
+    digits = ImageDataset.from_digits(os.path.join(work_dir, 'digits'))
+    train, test = digits.train_test_split(random_state=0)
+    model = digits.partial_fit(GaussianNB(), train, random_state=0)
+    print('digits GaussianNB accuracy: %.3f' % digits.score(model, test))
+
+    # cached pixel statistics follow the images they were computed from
+    root = os.path.join(work_dir, 'stats')
+    mean, _ = make_synthetic_images(root, 1000).pixel_stats()
+    data = make_synthetic_images(root, 500, random_state=1)
+    assert not np.allclose(data.pixel_stats()[0], mean)
+    first = np.array(data.images[:10])
+    del data
+    np.save(os.path.join(root, 'images.npy'), first)
+    assert np.allclose(ImageDataset(root).pixel_stats()[0],
+                       first.reshape(10, -1).mean(axis=0))
+
+    for shape in [(8, 8), (62, 47)]:
+        n = n_images if shape == (8, 8) else n_images // 20
+        root = os.path.join(work_dir, 'synthetic_%dx%d' % shape)
+        t0 = perf_counter()
+        data = make_synthetic_images(root, n, shape)
+        t1 = perf_counter()
+        train, test = data.train_test_split(random_state=0)
+        model = data.partial_fit(GaussianNB(), train, batch_size=65536,
+                                 random_state=0)
+        t2 = perf_counter()
+        print('%d %dx%d images: write %.1fs, partial_fit %.1fs, '
+              'accuracy %.3f (%.0f MB on disk)'
+              % (n, shape[0], shape[1], t1 - t0, t2 - t1,
+                 data.score(model, test, batch_size=65536),
+                 data.images.nbytes / 1e6))
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""Parallel, chunked TF-IDF + MultinomialNB training on a synthetic corpus
+
+05_05_naive_bayes.py fits `make_pipeline(TfidfVectorizer(), MultinomialNB())`
+on `fetch_20newsgroups` in one shot, on a single core, and needs a download
+to run at all.  This module provides:
+
+* `make_synthetic_newsgroups`, an offline stand-in for the four categories
+  used in the lecture ('talk.religion.misc', 'soc.religion.christian',
+  'sci.space', 'comp.graphics'): every category has its own topic words and
+  all share a Zipf-distributed pool of common words,
+* `fit_parallel`, which trains the same model over shards of the corpus, with
+  the tokenizing done in worker processes:
+
+  1. each worker tokenizes its shard with a `CountVectorizer` and returns
+     the shard's count matrix over its own local vocabulary,
+  2. the parent merges the local vocabularies, remaps each shard's columns
+     onto the merged one and derives the global idf from the remapped
+     counts,
+  3. every shard is weighted to TF-IDF and fed to
+     `MultinomialNB.partial_fit`, which just adds up the class count
+     matrices.
+
+The result is a pipeline equivalent to fitting `TfidfVectorizer()` and
+`MultinomialNB()` on the whole corpus at once.  Running the module reports
+the scaling from 1 to N worker processes.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import (CountVectorizer,
+                                             TfidfTransformer,
+                                             TfidfVectorizer)
+from sklearn.naive_bayes import MultinomialNB
+from sklearn.pipeline import make_pipeline
+from sklearn.utils import Bunch
+
+CATEGORIES = ['talk.religion.misc', 'soc.religion.christian',
+              'sci.space', 'comp.graphics']
+
+TOPIC_WORDS = {
+    'talk.religion.misc': 'religion belief moral atheist faith argument '
+                          'truth koresh cult evidence morality objective',
+    'soc.religion.christian': 'god jesus christ church bible christian '
+                              'prayer scripture sin faith lord heaven',
+    'sci.space': 'space nasa orbit launch shuttle moon satellite rocket '
+                 'mission earth payload iss',
+    'comp.graphics': 'graphics image screen resolution file format jpeg '
+                     'polygon rendering color pixel software',
+}
+
+
+def make_synthetic_newsgroups(n_docs=10000, doc_length=120,
+                              n_common_words=5000, topic_fraction=0.03,
+                              random_state=0):
+    """Bunch with `data`, `target` and `target_names` like fetch_20newsgroups
+
+    Each document draws about `topic_fraction` of its words from its
+    category's topic words (so neighbouring categories share some) and the
+    rest from a common Zipfian vocabulary.
+    """
+    rng = np.random.RandomState(random_state)
+    common = np.array(['w%04d' % i for i in range(n_common_words)],
+                      dtype=object)
+    zipf = 1. / np.arange(1, n_common_words + 1)
+    zipf /= zipf.sum()
+    topics = [np.array(TOPIC_WORDS[c].split()) for c in CATEGORIES]
+
+    target = rng.randint(0, len(CATEGORIES), n_docs)
+    lengths = rng.poisson(doc_length, n_docs) + 1
+    n_topic = rng.binomial(lengths, topic_fraction)
+    words = common[rng.choice(n_common_words, lengths.sum(), p=zipf)]
+
+    data = []
+    start = 0
+    for label, length, k in zip(target, lengths, n_topic):
+        doc = words[start:start + length]
+        doc[:k] = topics[label][rng.randint(0, len(topics[label]), k)]
+        rng.shuffle(doc)
+        data.append(' '.join(doc))
+        start += length
+    return Bunch(data=data, target=target, target_names=list(CATEGORIES))
+
+
+def _tokenize_shard(docs):
+    """Count matrix of one shard over its own (sorted) local vocabulary"""
+    vectorizer = CountVectorizer()
+    counts = vectorizer.fit_transform(docs)
+    return vectorizer.get_feature_names_out(), counts
+
+
+def _shards(n, n_shards):
+    bounds = np.linspace(0, n, n_shards + 1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def fit_parallel(docs, target, n_jobs=None, shard_size=2000, classes=None):
+    """Fit TF-IDF + MultinomialNB over document shards in `n_jobs` processes
+
+    Returns a fitted pipeline of `CountVectorizer` (frozen vocabulary),
+    `TfidfTransformer` (global idf) and `MultinomialNB`.
+    """
+    n_jobs = n_jobs or os.cpu_count()
+    target = np.asarray(target)
+    classes = np.unique(target) if classes is None else classes
+    shards = _shards(len(docs), max(n_jobs, -(-len(docs) // shard_size)))
+    pieces = [docs[a:b] for a, b in shards]
+
+    # tokenize in the workers
+    if n_jobs == 1:
+        results = [_tokenize_shard(piece) for piece in pieces]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(_tokenize_shard, pieces))
+
+    # merge the local vocabularies; both sides are sorted, so remapping the
+    # column indices keeps every row's indices sorted
+    vocabulary = np.unique(np.concatenate([terms for terms, _ in results]))
+    df = np.zeros(len(vocabulary))
+    matrices = []
+    for terms, counts in results:
+        columns = np.searchsorted(vocabulary, terms)
+        counts = sparse.csr_matrix(
+            (counts.data, columns[counts.indices], counts.indptr),
+            shape=(counts.shape[0], len(vocabulary)))
+        df += np.bincount(counts.indices, minlength=len(vocabulary))
+        matrices.append(counts)
+
+    tfidf = TfidfTransformer()
+    tfidf.idf_ = np.log((1 + len(docs)) / (1 + df)) + 1
+
+    # accumulate the class count matrices shard by shard
+    nb = MultinomialNB()
+    for (a, b), counts in zip(shards, matrices):
+        nb.partial_fit(tfidf.transform(counts), target[a:b], classes=classes)
+
+    vectorizer = CountVectorizer(
+        vocabulary={term: i for i, term in enumerate(vocabulary)})
+    return make_pipeline(vectorizer, tfidf, nb)
+
+
+if __name__ == '__main__':
+    import sys
+    from time import perf_counter
+
+    n_docs = int(float(sys.argv[1])) if len(sys.argv) > 1 else 40000
+    train = make_synthetic_newsgroups(n_docs, random_state=0)
+    test = make_synthetic_newsgroups(n_docs // 4, random_state=1)
+
+    t0 = perf_counter()
+    model = make_pipeline(TfidfVectorizer(), MultinomialNB())
+    model.fit(train.data, train.target)
+    baseline = perf_counter() - t0
+    print('%d documents, single fit: %.2fs, accuracy %.3f'
+          % (n_docs, baseline, model.score(test.data, test.target)))
+
+    n_cores = os.cpu_count()
+    jobs = sorted({1, 2, 4, n_cores} & set(range(1, n_cores + 1)))
+    print('%6s %8s %8s %9s' % ('n_jobs', 'time', 'speedup', 'accuracy'))
+    for n_jobs in jobs:
+        t0 = perf_counter()
+        parallel = fit_parallel(train.data, train.target, n_jobs=n_jobs)
+        elapsed = perf_counter() - t0
+        print('%6d %7.2fs %7.2fx %9.3f'
+              % (n_jobs, elapsed, baseline / elapsed,
+                 parallel.score(test.data, test.target)))
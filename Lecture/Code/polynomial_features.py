@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""Polynomial feature expansion with memory planning and streaming fits
+
+`PolynomialFeatures(degree=3)` in 05_04_feature_engineering.py and
+`make_pipeline(PolynomialFeatures(7), LinearRegression())` in
+05_06_linear_regression.py materialize every monomial column of the full
+design matrix before the regression sees it.  This module splits that into
+three pieces:
+
+* `n_output_features` / `plan_rows` predict the number of output columns
+  and how many rows fit in a memory budget *before* anything is allocated,
+* `PolynomialExpansion` builds each degree-k column as one multiply of a
+  degree-(k-1) column by an input feature, writing into a preallocated
+  (optionally caller-supplied) array.  Columns come out in the same order
+  as Scikit-Learn's `PolynomialFeatures`,
+* `StreamingPolynomialRegression` expands one row block at a time into a
+  reused buffer and only accumulates the centered normal equations
+  (`NormalEquations`), so the full design matrix never exists.
+
+    model = StreamingPolynomialRegression(degree=7).fit(x[:, None], y)
+    yfit = model.predict(xfit[:, None])
+"""
+
+from math import comb
+
+import numpy as np
+from sklearn.base import BaseEstimator, RegressorMixin, TransformerMixin
+
+# default budget for one expanded row block
+BLOCK_BYTES = 32 * 1024 * 1024
+
+
+def n_output_features(n_features, degree, include_bias=True,
+                      interaction_only=False):
+    """Number of columns PolynomialFeatures would produce"""
+    if interaction_only:
+        n = sum(comb(n_features, k) for k in range(1, degree + 1))
+    else:
+        n = comb(n_features + degree, degree) - 1
+    return n + bool(include_bias)
+
+
+def plan_rows(n_features, degree, budget_bytes=BLOCK_BYTES, dtype=np.float64,
+              include_bias=True, interaction_only=False):
+    """Rows of expanded output that fit into `budget_bytes`"""
+    n_out = n_output_features(n_features, degree, include_bias,
+                              interaction_only)
+    return max(1, budget_bytes // (n_out * np.dtype(dtype).itemsize))
+
+
+def monomial_plan(n_features, degree, interaction_only=False):
+    """(parent, feature) pairs building every non-constant monomial
+
+    Column c of the degree>=1 output is ``out[parent[c]] * X[feature[c]]``,
+    with parent -1 meaning the constant 1.  Monomials are the sorted index
+    tuples of `itertools.combinations_with_replacement` (or `combinations`),
+    ordered by degree and then lexicographically.
+    """
+    parents, features, powers = [], [], []
+    previous = [(-1, -1)]                # (column, last feature) per monomial
+    for _ in range(degree):
+        current = []
+        for column, last in previous:
+            first = last + 1 if interaction_only else max(last, 0)
+            for j in range(first, n_features):
+                current.append((len(parents), j))
+                parents.append(column)
+                features.append(j)
+                exponents = (powers[column].copy() if column >= 0
+                             else np.zeros(n_features, dtype=int))
+                exponents[j] += 1
+                powers.append(exponents)
+        previous = current
+    return np.array(parents), np.array(features), np.array(powers)
+
+
+class PolynomialExpansion(BaseEstimator, TransformerMixin):
+    """PolynomialFeatures built column by column into a preallocated array"""
+
+    def __init__(self, degree=2, interaction_only=False, include_bias=True,
+                 dtype=np.float64):
+        self.degree = degree
+        self.interaction_only = interaction_only
+        self.include_bias = include_bias
+        self.dtype = dtype
+
+    def fit(self, X, y=None):
+        self.n_features_in_ = np.shape(X)[1]
+        self.parents_, self.features_, powers = monomial_plan(
+            self.n_features_in_, self.degree, self.interaction_only)
+        if self.include_bias:
+            powers = np.vstack([np.zeros(self.n_features_in_, dtype=int),
+                                powers.reshape(-1, self.n_features_in_)])
+        self.powers_ = powers
+        self.n_output_features_ = len(powers)
+        return self
+
+    def transform(self, X, out=None):
+        X = np.asarray(X, dtype=self.dtype)
+        if out is None:
+            # column-major so every column write is contiguous
+            out = np.empty((len(X), self.n_output_features_),
+                           dtype=self.dtype, order='F')
+        offset = int(self.include_bias)
+        if offset:
+            out[:, 0] = 1
+        for c, (parent, j) in enumerate(zip(self.parents_, self.features_)):
+            if parent < 0:
+                out[:, offset + c] = X[:, j]
+            else:
+                np.multiply(out[:, offset + parent], X[:, j],
+                            out=out[:, offset + c])
+        return out
+
+    def get_feature_names_out(self, input_features=None):
+        if input_features is None:
+            input_features = ['x%d' % i for i in range(self.n_features_in_)]
+        names = []
+        for row in self.powers_:
+            terms = ['%s^%d' % (input_features[i], p) if p > 1
+                     else input_features[i]
+                     for i, p in enumerate(row) if p]
+            names.append(' '.join(terms) or '1')
+        return np.array(names, dtype=object)
+
+
+class NormalEquations:
+    """Mergeable centered X^T X / X^T y statistics for least squares
+
+    Blocks are combined with the pairwise (Chan et al.) update of means and
+    co-moments, which stays accurate for badly scaled columns such as
+    high polynomial powers.
+    """
+
+    def __init__(self, n_features):
+        self.n = 0
+        self.x_mean = np.zeros(n_features)
+        self.y_mean = 0.0
+        self.xx = np.zeros((n_features, n_features))
+        self.xy = np.zeros(n_features)
+
+    def update(self, X, y):
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        other = NormalEquations(X.shape[1])
+        other.n = len(X)
+        other.x_mean = X.mean(axis=0)
+        other.y_mean = y.mean()
+        Xc = X - other.x_mean
+        other.xx = Xc.T @ Xc
+        other.xy = Xc.T @ (y - other.y_mean)
+        return self.merge(other)
+
+    def merge(self, other):
+        if other.n == 0:
+            return self
+        n = self.n + other.n
+        dx = other.x_mean - self.x_mean
+        dy = other.y_mean - self.y_mean
+        f = self.n * other.n / n
+        self.xx += other.xx + f * np.outer(dx, dx)
+        self.xy += other.xy + f * dx * dy
+        self.x_mean += dx * other.n / n
+        self.y_mean += dy * other.n / n
+        self.n = n
+        return self
+
+    def solve(self, fit_intercept=True, rcond=None):
+        """Return ``coef, intercept`` of the least-squares fit"""
+        if fit_intercept:
+            xx, xy = self.xx, self.xy
+        else:
+            # uncentered moments from the centered ones
+            xx = self.xx + self.n * np.outer(self.x_mean, self.x_mean)
+            xy = self.xy + self.n * self.x_mean * self.y_mean
+        # Jacobi scaling before solving keeps polynomial columns comparable
+        scale = np.sqrt(np.diag(xx))
+        scale[scale == 0] = 1
+        coef = np.linalg.lstsq(xx / np.outer(scale, scale), xy / scale,
+                               rcond=rcond)[0] / scale
+        intercept = self.y_mean - self.x_mean @ coef if fit_intercept else 0.
+        return coef, intercept
+
+
+class StreamingPolynomialRegression(BaseEstimator, RegressorMixin):
+    """PolynomialFeatures + LinearRegression without the design matrix"""
+
+    def __init__(self, degree=2, interaction_only=False, fit_intercept=True,
+                 block_rows=None, budget_bytes=BLOCK_BYTES):
+        self.degree = degree
+        self.interaction_only = interaction_only
+        self.fit_intercept = fit_intercept
+        self.block_rows = block_rows
+        self.budget_bytes = budget_bytes
+
+    def _blocks(self, n_samples):
+        rows = self.block_rows or plan_rows(
+            self.n_features_in_, self.degree, self.budget_bytes,
+            include_bias=False, interaction_only=self.interaction_only)
+        for start in range(0, n_samples, rows):
+            yield start, min(start + rows, n_samples)
+
+    def fit(self, X, y):
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        self.n_features_in_ = X.shape[1]
+        self.expansion_ = PolynomialExpansion(
+            self.degree, self.interaction_only, include_bias=False).fit(X)
+        stats = NormalEquations(self.expansion_.n_output_features_)
+
+        buffer = None
+        for start, stop in self._blocks(len(X)):
+            if buffer is None:
+                buffer = np.empty((stop - start,
+                                   self.expansion_.n_output_features_),
+                                  order='F')
+            block = self.expansion_.transform(X[start:stop],
+                                              out=buffer[:stop - start])
+            stats.update(block, y[start:stop])
+
+        self.coef_, self.intercept_ = stats.solve(self.fit_intercept)
+        return self
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        y = np.empty(len(X))
+        for start, stop in self._blocks(len(X)):
+            block = self.expansion_.transform(X[start:stop])
+            y[start:stop] = block @ self.coef_ + self.intercept_
+        return y
+
+
+if __name__ == '__main__':
+    import tracemalloc
+    from time import perf_counter
+    from sklearn.linear_model import LinearRegression
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import PolynomialFeatures
+
+    rng = np.random.RandomState(0)
+    X = rng.rand(200000, 8)
+    y = X.sum(axis=1) ** 2 + 0.1 * rng.randn(len(X))
+    degree = 3
+    n_out = n_output_features(X.shape[1], degree, include_bias=False)
+    print('%d features, degree %d -> %d columns, %.0f MB dense'
+          % (X.shape[1], degree, n_out, len(X) * n_out * 8 / 1e6))
+
+    for label, model in [
+            ('PolynomialFeatures + LinearRegression',
+             make_pipeline(PolynomialFeatures(degree, include_bias=False),
+                           LinearRegression())),
+            ('StreamingPolynomialRegression',
+             StreamingPolynomialRegression(degree))]:
+        tracemalloc.start()
+        t0 = perf_counter()
+        model.fit(X, y)
+        elapsed = perf_counter() - t0
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('%-40s %.2fs  peak %6.1f MB  R^2 %.6f'
+              % (label, elapsed, peak / 1e6, model.score(X, y)))
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""Ridge and lasso coefficient paths over a Gaussian basis
+
+`basis_plot` in 05_06_linear_regression.py fits
+`make_pipeline(GaussianFeatures(30), Ridge(alpha=0.1))` (or `Lasso`) for a
+single alpha, recomputing the basis expansion on every call.  To see how
+the coefficients move with alpha, the expansion is done once here and then
+
+* the ridge solutions for *all* alphas come from one SVD of the centered
+  design matrix,  ``coef(alpha) = V diag(s / (s**2 + alpha)) U^T y``,
+* the lasso solutions come from coordinate descent along a decreasing alpha
+  grid, each fit warm-started from the previous one and working from the
+  precomputed Gram matrix (Scikit-Learn's `lasso_path`), so later alphas
+  take only a few sweeps.
+
+The ridge path returns the same coefficients as fitting `Ridge(alpha)`
+with ``fit_intercept=True`` one alpha at a time.  The lasso path matches
+`Lasso(alpha)` only up to the solver tolerance: the Gaussian features are
+strongly correlated, so near-optimal solutions with the same objective
+value can have quite different coefficients, and neither solver reaches the
+exact optimum for small alphas within the default `max_iter`.  Lower `tol`
+and raise `max_iter` when the coefficients themselves must agree.
+
+    alphas = np.logspace(-4, 1, 50)
+    path_plot(x, y, alphas, penalty='ridge')
+"""
+
+import numpy as np
+from sklearn.linear_model import lasso_path as _lasso_path
+
+from gaussian_features import GaussianFeatures
+
+
+def expand(x, N=30, width_factor=2.0):
+    """Fit the Gaussian basis to x once; return the transformer and design"""
+    x = np.asarray(x, dtype=np.float64).reshape(len(x), -1)
+    basis = GaussianFeatures(N, width_factor).fit(x)
+    return basis, basis.transform(x)
+
+
+def _center(X, y, fit_intercept):
+    if not fit_intercept:
+        return X, y, np.zeros(X.shape[1]), 0.0
+    X_mean, y_mean = X.mean(axis=0), y.mean()
+    return X - X_mean, y - y_mean, X_mean, y_mean
+
+
+def ridge_path(X, y, alphas, fit_intercept=True):
+    """Ridge coefficients for every alpha from a single SVD
+
+    Returns ``coefs`` of shape (n_alphas, n_features) and ``intercepts`` of
+    shape (n_alphas,).
+    """
+    X = np.asarray(X, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    alphas = np.atleast_1d(alphas).astype(np.float64)
+    Xc, yc, X_mean, y_mean = _center(X, y, fit_intercept)
+
+    U, s, Vt = np.linalg.svd(Xc, full_matrices=False)
+    Uty = U.T @ yc
+    shrink = s / (s ** 2 + alphas[:, np.newaxis])
+    coefs = (shrink * Uty) @ Vt
+    intercepts = y_mean - coefs @ X_mean
+    return coefs, intercepts
+
+
+def lasso_path(X, y, alphas, fit_intercept=True, max_iter=2000, tol=1e-4):
+    """Lasso coefficients along `alphas`, warm-started from large to small
+
+    Returns ``coefs`` and ``intercepts`` in the order of `alphas` as given.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    alphas = np.atleast_1d(alphas).astype(np.float64)
+    Xc, yc, X_mean, y_mean = _center(X, y, fit_intercept)
+
+    order = np.argsort(alphas)[::-1]
+    gram = Xc.T @ Xc
+    Xy = Xc.T @ yc
+    _, path, _ = _lasso_path(Xc, yc, alphas=alphas[order], precompute=gram,
+                             Xy=Xy, max_iter=max_iter, tol=tol)
+
+    coefs = np.empty((len(alphas), X.shape[1]))
+    coefs[order] = path.T
+    intercepts = y_mean - coefs @ X_mean
+    return coefs, intercepts
+
+
+def path_plot(x, y, alphas, penalty='ridge', N=30, ax=None, cmap='viridis'):
+    """Coefficient vs basis location for every alpha, as in `basis_plot`"""
+    import matplotlib.pyplot as plt
+    ax = ax or plt.gca()
+
+    basis, X = expand(x, N)
+    solver = ridge_path if penalty == 'ridge' else lasso_path
+    coefs, _ = solver(X, y, alphas)
+
+    colors = plt.get_cmap(cmap)(np.linspace(0, 1, len(alphas)))
+    for coef, alpha, color in zip(coefs, alphas, colors):
+        ax.plot(basis.centers_, coef, color=color, lw=1)
+    ax.set(xlabel='basis location', ylabel='coefficient',
+           title='%s path, alpha = %.g ... %.g'
+                 % (penalty, np.min(alphas), np.max(alphas)))
+    return coefs
+
+
+if __name__ == '__main__':
+    from time import perf_counter
+    from sklearn.linear_model import Lasso, Ridge
+    from sklearn.pipeline import make_pipeline
+
+    rng = np.random.RandomState(1)
+    x = 10 * rng.rand(50)
+    y = np.sin(x) + 0.1 * rng.randn(50)
+    alphas = np.logspace(-4, 0, 50)
+
+    def objective(X, coefs, intercepts, alphas, penalty):
+        """Penalized loss of each (coef, intercept), in sklearn's scaling"""
+        residual = y - coefs @ X.T - intercepts[:, np.newaxis]
+        if penalty == 'ridge':
+            return (residual ** 2).sum(axis=1) + alphas * (coefs ** 2).sum(1)
+        return ((residual ** 2).mean(axis=1) / 2
+                + alphas * np.abs(coefs).sum(axis=1))
+
+    # with the default tolerance the lasso objectives are close but the
+    # coefficients are not, and the looped fits warn that they did not
+    # converge for the small alphas; tightened, both agree
+    X = expand(x)[1]
+    for penalty, estimator, solver, kwargs in [
+            ('ridge', Ridge, ridge_path, {}),
+            ('lasso', Lasso, lasso_path, {}),
+            ('lasso', Lasso, lasso_path, dict(max_iter=200000, tol=1e-10))]:
+        t0 = perf_counter()
+        looped = [make_pipeline(GaussianFeatures(30),
+                                estimator(alpha=a, **kwargs))
+                  .fit(x[:, np.newaxis], y).steps[1][1] for a in alphas]
+        t1 = perf_counter()
+        coefs, intercepts = solver(X, y, alphas, **kwargs)
+        t2 = perf_counter()
+        looped_obj = objective(X, np.array([m.coef_ for m in looped]),
+                               np.array([m.intercept_ for m in looped]),
+                               alphas, penalty)
+        path_obj = objective(X, coefs, intercepts, alphas, penalty)
+        print('%s %s: one fit per alpha %.3fs, path %.3fs, max |diff| '
+              'coef %.1e, objective %.1e (relative)'
+              % (penalty, kwargs, t1 - t0, t2 - t1,
+                 np.abs(coefs - [m.coef_ for m in looped]).max(),
+                 np.max(np.abs(path_obj - looped_obj) / looped_obj)))
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""Secondary indexes for sample_data.csv-style sales tables
+
+The sample_data.csv lectures filter the same few columns over and over:
+
+    df[df['Country'] == 'Mexico']
+    df[(df['Units Sold'] >= 1000) & (df['Units Sold'] <= 2000)
+       & (df['Country'] == 'France')]
+
+each time scanning every row.  `SecondaryIndexes` keeps, next to the
+table:
+
+* a bitmap per distinct value of each low-cardinality column (Country,
+  Segment, ' Product ', ...), as packed 64-bit words, so combining
+  predicates is `&`, `|` and `~` over n/64 words,
+* sorted runs (`frame_search.SortedIndex`) of each numeric column (Units
+  Sold, ...), turned into bitmaps for a range,
+* `append`, which extends the bitmaps in place (capacity doubles, as for
+  a list) and adds the new rows as another sorted run.  Runs of similar
+  size are merged (size-tiered, like a binary counter: a run is merged
+  into the one before it while that is at most `merge_factor` times as
+  large), so there are O(log n) runs and each row is merged O(log n)
+  times over all appends.
+
+Predicates are written against ``indexes[column]`` and give `Bitmap`
+objects:
+
+    ix = SecondaryIndexes(df)
+    hits = ((ix['Country'] == 'France') | (ix['Country'] == 'Mexico')) \\
+        & ix['Units Sold'].between(1000, 2000)
+    df.iloc[hits.positions()]          # or ix.take(hits)
+    ix.append(new_rows)
+"""
+
+import numpy as np
+import pandas as pd
+
+from frame_search import SortedIndex
+
+
+def _pack(mask):
+    """Bool mask -> little-endian packed uint64 words"""
+    bits = np.packbits(mask, bitorder='little')
+    words = np.zeros(-(-len(mask) // 64), dtype=np.uint64)
+    words.view(np.uint8)[:len(bits)] = bits
+    return words
+
+
+class Bitmap:
+    """A set of row positions as packed bits; supports &, | and ~"""
+
+    def __init__(self, words, n):
+        self.words = words
+        self.n = n
+
+    @classmethod
+    def from_positions(cls, positions, n):
+        mask = np.zeros(n, dtype=bool)
+        mask[positions] = True
+        return cls(_pack(mask), n)
+
+    def __and__(self, other):
+        return Bitmap(self.words & other.words, self.n)
+
+    def __or__(self, other):
+        return Bitmap(self.words | other.words, self.n)
+
+    def __invert__(self):
+        words = ~self.words
+        if self.n % 64:                      # clear bits beyond the end
+            words[-1] &= np.uint64((1 << (self.n % 64)) - 1)
+        return Bitmap(words, self.n)
+
+    def __len__(self):
+        return self.n
+
+    def count(self):
+        return int(np.bitwise_count(self.words).sum())
+
+    def mask(self):
+        bits = np.unpackbits(self.words.view(np.uint8), bitorder='little')
+        return bits[:self.n].view(bool)
+
+    def positions(self):
+        return np.flatnonzero(self.mask())
+
+
+class _BitmapColumn:
+    """One growable bitmap per distinct value of a column"""
+
+    def __init__(self):
+        self.bitmaps = {}
+        self.n = 0
+
+    def extend(self, values):
+        start, self.n = self.n, self.n + len(values)
+        n_words = -(-self.n // 64)
+        for key, bitmap in self.bitmaps.items():
+            if len(bitmap) < n_words:
+                self.bitmaps[key] = self._grown(bitmap, n_words)
+        # the new rows' bits, packed from the word holding row `start`
+        first, offset = divmod(start, 64)
+        codes, uniques = pd.factorize(np.asarray(values))
+        mask = np.zeros(offset + len(values), dtype=bool)
+        for code, value in enumerate(uniques):
+            if value not in self.bitmaps:
+                self.bitmaps[value] = np.zeros(n_words, dtype=np.uint64)
+            mask[offset:] = codes == code
+            words = _pack(mask)
+            self.bitmaps[value][first:first + len(words)] |= words
+
+    @staticmethod
+    def _grown(bitmap, n_words):
+        grown = np.zeros(max(n_words, 2 * len(bitmap)), dtype=np.uint64)
+        grown[:len(bitmap)] = bitmap
+        return grown
+
+    def get(self, value):
+        n_words = -(-self.n // 64)
+        bitmap = self.bitmaps.get(value)
+        if bitmap is None:
+            return Bitmap(np.zeros(n_words, dtype=np.uint64), self.n)
+        return Bitmap(bitmap[:n_words].copy(), self.n)
+
+
+class _SortedColumn:
+    """A column as a few sorted runs, each a `SortedIndex`"""
+
+    def __init__(self, merge_factor=2):
+        self.runs = []
+        self.merge_factor = merge_factor
+        self.n = 0
+
+    def extend(self, values):
+        run = SortedIndex(values)
+        run.positions = run.positions + self.n
+        self.n += len(values)
+        # run sizes at least grow by `merge_factor` from last to first
+        while self.runs and (len(self.runs[-1].values)
+                             <= self.merge_factor * len(run.values)):
+            run = self._merge(self.runs.pop(), run)
+        self.runs.append(run)
+
+    @staticmethod
+    def _merge(first, second):
+        merged = SortedIndex.__new__(SortedIndex)
+        values = np.concatenate([first.values, second.values])
+        # a stable sort of two sorted runs is a linear merge
+        order = np.argsort(values, kind='stable')
+        merged.values = values[order]
+        merged.positions = np.concatenate([first.positions,
+                                           second.positions])[order]
+        return merged
+
+    def range(self, low=None, high=None, inclusive='both'):
+        return np.concatenate([r.range(low, high, inclusive)
+                               for r in self.runs]
+                              + [np.empty(0, dtype=np.int64)])
+
+
+class _ColumnPredicates:
+    """``indexes[column]``: comparisons that produce `Bitmap` objects"""
+
+    def __init__(self, indexes, column):
+        self.indexes = indexes
+        self.column = column
+
+    def _bitmap(self, positions):
+        return Bitmap.from_positions(positions, len(self.indexes))
+
+    def __eq__(self, value):
+        bitmaps = self.indexes.bitmaps.get(self.column)
+        if bitmaps is not None:
+            return bitmaps.get(value)
+        return self.between(value, value)
+
+    def __ne__(self, value):
+        # missing values are != anything, as with pandas masks
+        return ~(self == value)
+
+    def isin(self, values):
+        result = None
+        for value in values:
+            bitmap = self == value
+            result = bitmap if result is None else result | bitmap
+        return result if result is not None else self._bitmap([])
+
+    def between(self, low, high, inclusive='both'):
+        runs = self.indexes.sorted.get(self.column)
+        if runs is None:
+            values = self.indexes.frame[self.column]
+            mask = np.ones(len(values), dtype=bool)
+            # one-sided bounds: `between` would compare with None
+            if low is not None:
+                mask &= (values >= low if inclusive in ('both', 'left')
+                         else values > low).to_numpy()
+            if high is not None:
+                mask &= (values <= high if inclusive in ('both', 'right')
+                         else values < high).to_numpy()
+            return Bitmap(_pack(mask), len(self.indexes))
+        return self._bitmap(runs.range(low, high, inclusive))
+
+    def __lt__(self, value):
+        return self.between(None, value, 'neither')
+
+    def __le__(self, value):
+        return self.between(None, value, 'right')
+
+    def __gt__(self, value):
+        return self.between(value, None, 'neither')
+
+    def __ge__(self, value):
+        return self.between(value, None, 'left')
+
+
+class SecondaryIndexes:
+    """Bitmap and sorted indexes over a table that grows by appending
+
+    By default, non-numeric columns with at most `max_cardinality`
+    distinct values get bitmaps and numeric columns get sorted runs.
+    """
+
+    def __init__(self, df, bitmap_columns=None, sorted_columns=None,
+                 max_cardinality=64, merge_factor=2):
+        if bitmap_columns is None:
+            bitmap_columns = [c for c in df.columns
+                              if df[c].dtype.kind not in 'biufcmM'
+                              and df[c].nunique() <= max_cardinality]
+        if sorted_columns is None:
+            sorted_columns = [c for c in df.columns
+                              if df[c].dtype.kind in 'biuf']
+        self.bitmaps = {c: _BitmapColumn() for c in bitmap_columns}
+        self.sorted = {c: _SortedColumn(merge_factor) for c in sorted_columns}
+        self._chunks = []
+        self._frame = None
+        self.n = 0
+        self.append(df)
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, column):
+        return _ColumnPredicates(self, column)
+
+    @property
+    def frame(self):
+        """The whole table (the appended chunks, concatenated on demand)"""
+        if self._frame is None or len(self._frame) != self.n:
+            self._frame = pd.concat(self._chunks, ignore_index=True)
+            self._chunks = [self._frame]
+        return self._frame
+
+    def append(self, rows):
+        """Add `rows` (a DataFrame with the same columns) to the table"""
+        for column, index in self.bitmaps.items():
+            index.extend(rows[column].to_numpy())
+        for column, index in self.sorted.items():
+            index.extend(rows[column].to_numpy())
+        self._chunks.append(rows)
+        self.n += len(rows)
+        return self
+
+    def take(self, bitmap):
+        return self.frame.iloc[bitmap.positions()]
+
+
+if __name__ == '__main__':
+    import sys
+    from timeit import timeit
+
+    sample = pd.read_csv('sample_data.csv')
+    n = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10000000
+    rng = np.random.RandomState(0)
+    df = sample.iloc[rng.randint(0, len(sample), n)].reset_index(drop=True)
+    df['Units Sold'] += rng.randint(0, 100, n)
+
+    t_build = timeit(lambda: SecondaryIndexes(df), number=1)
+    ix = SecondaryIndexes(df)
+
+    def with_index():
+        hits = ((ix['Country'] == 'France') | (ix['Country'] == 'Mexico')) \
+            & (ix['Segment'] == 'Government') \
+            & (ix[' Product '] != ' Amarilla ') \
+            & ix['Units Sold'].between(1000, 2000)
+        return hits.positions()
+
+    def with_masks():
+        return np.flatnonzero(df['Country'].isin(['France', 'Mexico'])
+                              & (df['Segment'] == 'Government')
+                              & (df[' Product '] != ' Amarilla ')
+                              & df['Units Sold'].between(1000, 2000))
+
+    assert np.array_equal(with_index(), with_masks())
+
+    # range predicates on a column without sorted runs
+    small = pd.DataFrame({'b': [1, 5, 2, np.nan, 3]})
+    unsorted = SecondaryIndexes(small, sorted_columns=[])
+    for predicate, expected in [(unsorted['b'] < 2, [0]),
+                                (unsorted['b'] <= 2, [0, 2]),
+                                (unsorted['b'] > 2, [1, 4]),
+                                (unsorted['b'] >= 3, [1, 4]),
+                                (unsorted['b'].between(2, 3), [2, 4])]:
+        assert predicate.positions().tolist() == expected
+    n_queries = 10
+    t_index = timeit(with_index, number=n_queries) / n_queries
+    t_mask = timeit(with_masks, number=n_queries) / n_queries
+    bitmap_only = timeit(lambda: ((ix['Country'] == 'France')
+                                  & (ix['Segment'] == 'Government')).count(),
+                         number=n_queries) / n_queries
+
+    extra = sample.iloc[rng.randint(0, len(sample), 100000)]
+    t_append = timeit(lambda: ix.append(extra), number=n_queries) / n_queries
+    hits = (ix['Country'] == 'France') & ix['Units Sold'].between(1000, 2000)
+    frame = ix.frame
+    sizes = [len(r.values) for r in ix.sorted['Units Sold'].runs]
+    assert sizes == sorted(sizes, reverse=True) and len(sizes) <= 3
+    assert np.array_equal(hits.positions(), np.flatnonzero(
+        (frame['Country'] == 'France')
+        & frame['Units Sold'].between(1000, 2000)))
+
+    print('%d rows; indexes built in %.1fs' % (n, t_build))
+    print('4-predicate filter: boolean masks %.0fms, indexes %.0fms; '
+          'bitmap-only count %.1fms'
+          % (1000 * t_mask, 1000 * t_index, 1000 * bitmap_only))
+    print('append 100000 rows: %.0fms' % (1000 * t_append))
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""Mergeable summary sketches for streaming statistics
+
+Streaming code cannot call ``df['col'].mean()`` or ``.median()`` on data it
+never holds in memory.  The sketches here consume values chunk by chunk and
+can be merged, so partial results from different chunks, files or worker
+processes combine into the statistics of the whole:
+
+* `TDigest`, a merging t-digest giving approximate quantiles (the median in
+  particular) with bounded memory and best accuracy in the tails,
+* `SummarySketch`, count / sum / sum of squared deviations from the mean
+  / min / max plus a `TDigest`, i.e. everything `describe()` reports.
+  Chunks and sketches are combined with the pairwise (Chan et al.)
+  update, so the variance stays accurate when the mean is large compared
+  to the spread.
+
+NaN values are ignored, as pandas does.
+
+    sketch = SummarySketch()
+    for chunk in pd.read_csv('lecture10.csv', chunksize=2):
+        sketch.update(chunk['val1'])
+    sketch.mean(), sketch.median()
+"""
+
+import numpy as np
+
+
+class TDigest:
+    """Merging t-digest with the arcsine scale function
+
+    Centroids are kept as sorted arrays of means and weights.  Incoming
+    values are buffered and folded in by `compress`, which sorts everything
+    and groups neighbours whose scaled quantile falls into the same unit
+    interval, entirely with vectorized NumPy operations.
+    """
+
+    def __init__(self, compression=200, buffer_size=None):
+        self.compression = compression
+        self.buffer_size = buffer_size or 20 * compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self._buffer = []
+        self._buffered = 0
+
+    @property
+    def count(self):
+        self.compress()
+        return self.weights.sum()
+
+    def update(self, values, weights=None):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if weights is None:
+            keep = ~np.isnan(values)
+            values, weights = values[keep], np.ones(keep.sum())
+        if len(values):
+            self._buffer.append((values, np.asarray(weights, np.float64)))
+            self._buffered += len(values)
+            if self._buffered >= self.buffer_size:
+                self.compress()
+        return self
+
+    def merge(self, other):
+        other.compress()
+        return self.update(other.means, other.weights)
+
+    def compress(self):
+        if not self._buffer:
+            return self
+        means = np.concatenate([self.means] + [m for m, _ in self._buffer])
+        weights = np.concatenate([self.weights]
+                                 + [w for _, w in self._buffer])
+        self._buffer, self._buffered = [], 0
+
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        cum = np.cumsum(weights)
+        q = (cum - weights / 2) / cum[-1]
+        k = self.compression / (2 * np.pi) * np.arcsin(2 * q - 1)
+        cluster = np.floor(k)
+        starts = np.r_[0, np.flatnonzero(np.diff(cluster)) + 1]
+
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+        return self
+
+    def quantile(self, q):
+        """Approximate quantile(s) by interpolating between centroids"""
+        self.compress()
+        if not len(self.weights):
+            return np.full(np.shape(q), np.nan)[()]
+        cum = np.cumsum(self.weights)
+        mid = (cum - self.weights / 2) / cum[-1]
+        return np.interp(q, mid, self.means)
+
+
+class SummarySketch:
+    """count, sum, m2, min, max and a t-digest of one column"""
+
+    def __init__(self, compression=200):
+        self.n = 0
+        self.sum = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.digest = TDigest(compression)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if len(values):
+            total = values.sum()
+            deviation = values - total / len(values)
+            self._combine(len(values), total, deviation @ deviation)
+            self.min = min(self.min, values.min())
+            self.max = max(self.max, values.max())
+            self.digest.update(values, np.ones(len(values)))
+        return self
+
+    def _combine(self, n, total, m2):
+        """Fold count, sum and m2 of other values into the sketch"""
+        if self.n:
+            delta = total / n - self.sum / self.n
+            m2 += delta * delta * self.n * n / (self.n + n)
+        self.n += n
+        self.sum += total
+        self.m2 += m2
+
+    def merge(self, other):
+        if not other.n:
+            return self
+        self._combine(other.n, other.sum, other.m2)
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.digest.merge(other.digest)
+        return self
+
+    def mean(self):
+        return self.sum / self.n if self.n else np.nan
+
+    def var(self, ddof=1):
+        if self.n <= ddof:
+            return np.nan
+        return self.m2 / (self.n - ddof)
+
+    def std(self, ddof=1):
+        return np.sqrt(self.var(ddof))
+
+    def quantile(self, q):
+        if not self.n:
+            return np.nan
+        return np.clip(self.digest.quantile(q), self.min, self.max)
+
+    def median(self):
+        return self.quantile(0.5)
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(0)
+    values = np.r_[rng.lognormal(0, 1, 100000), np.nan]
+    # merged from chunks, as from worker processes
+    sketch = SummarySketch()
+    for chunk in np.array_split(values, 7):
+        sketch.merge(SummarySketch().update(chunk))
+    print('mean %.4f std %.4f median %.4f (exact %.4f %.4f %.4f)'
+          % (sketch.mean(), sketch.std(), sketch.median(),
+             np.nanmean(values), np.nanstd(values, ddof=1),
+             np.nanmedian(values)))
+    assert np.isclose(sketch.std(), np.nanstd(values, ddof=1))
+    assert abs(sketch.median() / np.nanmedian(values) - 1) < 1e-2
+
+    # a large offset cancels catastrophically in sumsq - sum ** 2 / n
+    offset = 1e9 + rng.rand(100000)
+    sketch = SummarySketch()
+    for chunk in np.array_split(offset, 7):
+        sketch.update(chunk)
+    assert np.isclose(sketch.var(), np.var(offset, ddof=1), rtol=1e-6)
@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""Streaming, mergeable groupby-aggregate for files larger than memory
+
+03_08_aggregation_and_grouping.py summarizes the planets table by
+discovery method:
+
+    planets.groupby('method')['orbital_period'].median()
+    planets.groupby('method')['year'].describe()
+    df.groupby('key').aggregate(['min', np.median, max])
+
+all on a frame held in memory.  `StreamingGroupBy` computes the same
+statistics from row chunks, keeping per group and column only
+
+* count, sum, sum of squared deviations from the mean, min and max, as
+  arrays indexed by a group code (grown by doubling as new groups appear),
+  updated per chunk with one sort by group code and `reduceat`; chunk and
+  worker states are combined with the pairwise (Chan et al.) update, as in
+  `polynomial_features.NormalEquations`, so the variance does not suffer
+  from cancellation for large means,
+* a `sketches.TDigest` for the median and other quantiles (optional).
+
+States from different chunks, files or worker processes `merge` into the
+state of the whole, so `grouped_summary` can read a CSV once and let a
+process pool summarize the chunks.  Missing keys are dropped and missing
+values ignored, as `groupby` does.
+
+    state = grouped_summary('planets.csv', 'method', ['orbital_period'])
+    state.aggregate(['count', 'min', 'median', 'max'])
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from sketches import SummarySketch, TDigest
+from streaming_pipeline import iter_chunks
+
+STATISTICS = ('count', 'sum', 'mean', 'var', 'std', 'min', 'max', 'median')
+
+
+class StreamingGroupBy:
+    """Per-group count / sum / m2 / min / max (and t-digests)
+
+    `by` is a column name or a list of them; `columns` a column name (the
+    results are then flat, as for ``groupby(by)[column]``) or a list.
+    """
+
+    def __init__(self, by, columns, compression=200, quantiles=True):
+        self.by = by
+        self.columns = columns
+        self.compression = compression
+        self.quantiles = quantiles
+        self.keys = []
+        self._codes = {}
+        n_columns = len(self._columns)
+        self.n = np.zeros((n_columns, 0), dtype=np.int64)
+        self.sum = np.zeros((n_columns, 0))
+        self.m2 = np.zeros((n_columns, 0))
+        self.min = np.zeros((n_columns, 0))
+        self.max = np.zeros((n_columns, 0))
+        self.digests = [[] for _ in range(n_columns)]
+
+    @property
+    def _columns(self):
+        return [self.columns] if isinstance(self.columns, str) \
+            else list(self.columns)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _code(self, keys):
+        """Group codes of `keys`, adding unseen ones"""
+        codes = np.empty(len(keys), dtype=np.int64)
+        for i, key in enumerate(keys):
+            code = self._codes.get(key)
+            if code is None:
+                code = self._codes[key] = len(self.keys)
+                self.keys.append(key)
+            codes[i] = code
+        if len(self.keys) > self.n.shape[1]:
+            self._grow(len(self.keys))
+        return codes
+
+    def _grow(self, n_groups):
+        capacity = max(n_groups, 2 * self.n.shape[1])
+        for name, fill in [('n', 0), ('sum', 0), ('m2', 0),
+                           ('min', np.inf), ('max', -np.inf)]:
+            old = getattr(self, name)
+            new = np.full((len(old), capacity), fill, dtype=old.dtype)
+            new[:, :old.shape[1]] = old
+            setattr(self, name, new)
+
+    def update(self, chunk):
+        """Fold a DataFrame chunk into the state"""
+        by = [self.by] if isinstance(self.by, str) else list(self.by)
+        keys = chunk[by]
+        keep = keys.notna().all(axis=1).to_numpy()
+        if not keep.all():
+            chunk, keys = chunk[keep], keys[keep]
+        if not len(chunk):
+            return self
+        if len(by) == 1:
+            local, uniques = pd.factorize(keys[by[0]])
+        else:
+            local, uniques = pd.factorize(pd.MultiIndex.from_frame(keys))
+        codes = self._code(list(uniques))[local]
+
+        values = chunk[self._columns].to_numpy(dtype=np.float64)
+        order = np.argsort(codes, kind='stable')
+        codes, values = codes[order], values[order]
+        starts = np.r_[0, np.flatnonzero(np.diff(codes)) + 1]
+        groups = codes[starts]
+        missing = np.isnan(values)
+        count = np.add.reduceat(~missing, starts)
+        total = np.add.reduceat(np.where(missing, 0, values), starts)
+        # squared deviations from the group mean within this chunk
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = total / count
+        row_group = np.repeat(np.arange(len(starts)),
+                              np.diff(np.r_[starts, len(codes)]))
+        deviation = np.where(missing, 0, values - mean[row_group])
+        m2 = np.add.reduceat(deviation * deviation, starts)
+        self._combine(groups, count.T, total.T, m2.T)
+        low = np.minimum.reduceat(np.where(missing, np.inf, values), starts)
+        high = np.maximum.reduceat(np.where(missing, -np.inf, values),
+                                   starts)
+        self.min[:, groups] = np.minimum(self.min[:, groups], low.T)
+        self.max[:, groups] = np.maximum(self.max[:, groups], high.T)
+        if self.quantiles:
+            stops = np.r_[starts[1:], len(codes)]
+            for j, digests in enumerate(self.digests):
+                digests.extend(None for _ in range(len(self) - len(digests)))
+                for group, start, stop in zip(groups, starts, stops):
+                    if digests[group] is None:
+                        digests[group] = TDigest(self.compression)
+                    digests[group].update(values[start:stop, j])
+        return self
+
+    def _combine(self, groups, n, total, m2):
+        """Fold count, sum and m2 of other rows of `groups` into the state"""
+        n_self, sum_self = self.n[:, groups], self.sum[:, groups]
+        n_both = n_self + n
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = (np.where(n > 0, total / n, 0)
+                     - np.where(n_self > 0, sum_self / n_self, 0))
+            f = np.where(n_both > 0, n_self * n / n_both, 0)
+        self.m2[:, groups] += m2 + f * delta * delta
+        self.n[:, groups] = n_both
+        self.sum[:, groups] += total
+
+    def merge(self, other):
+        """Fold in the state of other chunks (same `by` and `columns`)"""
+        if not len(other):
+            return self
+        groups = self._code(other.keys)
+        m = len(other)
+        self._combine(groups, other.n[:, :m], other.sum[:, :m],
+                      other.m2[:, :m])
+        self.min[:, groups] = np.minimum(self.min[:, groups],
+                                         other.min[:, :m])
+        self.max[:, groups] = np.maximum(self.max[:, groups],
+                                         other.max[:, :m])
+        if self.quantiles and other.quantiles:
+            for digests, theirs in zip(self.digests, other.digests):
+                digests.extend(None for _ in range(len(self) - len(digests)))
+                for group, digest in zip(groups, theirs):
+                    if digest is None:
+                        continue
+                    if digests[group] is None:
+                        digests[group] = TDigest(self.compression)
+                    digests[group].merge(digest)
+        return self
+
+    def sketch(self, key, column=None):
+        """`SummarySketch` of one group and column"""
+        j = self._columns.index(column) if column is not None else 0
+        g = self._codes[key]
+        sketch = SummarySketch(self.compression)
+        sketch.n, sketch.sum, sketch.m2 = (int(self.n[j, g]),
+                                           self.sum[j, g], self.m2[j, g])
+        sketch.min, sketch.max = self.min[j, g], self.max[j, g]
+        if self.quantiles and self.digests[j][g] is not None:
+            sketch.digest = self.digests[j][g]
+        return sketch
+
+    def _index(self):
+        """Group keys in sorted order, and the code of each"""
+        if isinstance(self.by, str):
+            index = pd.Index(self.keys, name=self.by)
+        else:
+            index = pd.MultiIndex.from_tuples(self.keys, names=self.by)
+        order = index.argsort()
+        return index[order], order
+
+    def quantile(self, q, column=None):
+        """Approximate `q` quantile of each group, as a Series"""
+        j = self._columns.index(column) if column is not None else 0
+        if not self.quantiles:
+            raise ValueError('quantiles=False: no digests were kept')
+        index, order = self._index()
+        digests = self.digests[j] + [None] * (len(self) - len(self.digests[j]))
+        values = [np.clip(digests[g].quantile(q), self.min[j, g],
+                          self.max[j, g])
+                  if digests[g] is not None and self.n[j, g] else np.nan
+                  for g in order]
+        return pd.Series(values, index=index, name=column or self._columns[0])
+
+    def aggregate(self, stats=('count', 'mean', 'std', 'min', 'median',
+                               'max'), ddof=1):
+        """Frame of `stats` (from `STATISTICS`) per group, sorted by key
+
+        With several columns, the result columns are ``(column, stat)``.
+        """
+        index, order = self._index()
+        m = len(self)
+        n = self.n[:, :m][:, order].astype(np.float64)
+        total = self.sum[:, :m][:, order]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(n > 0, total / n, np.nan)
+            var = np.where(n > ddof, self.m2[:, :m][:, order] / (n - ddof),
+                           np.nan)
+        results = {'count': n.astype(np.int64), 'sum': total, 'mean': mean,
+                   'var': var, 'std': np.sqrt(var),
+                   'min': np.where(n > 0, self.min[:, :m][:, order], np.nan),
+                   'max': np.where(n > 0, self.max[:, :m][:, order], np.nan)}
+        frames = {}
+        for j, column in enumerate(self._columns):
+            data = {}
+            for stat in stats:
+                if stat == 'median':
+                    data[stat] = self.quantile(0.5, column).to_numpy()
+                elif stat in results:
+                    data[stat] = results[stat][j]
+                else:
+                    raise ValueError('unknown statistic %r; use one of %s'
+                                     % (stat, ', '.join(STATISTICS)))
+            frames[column] = pd.DataFrame(data, index=index)
+        if isinstance(self.columns, str):
+            return frames[self.columns]
+        return pd.concat(frames, axis=1)
+
+
+def _summarize(chunk, by, columns, compression, quantiles):
+    return StreamingGroupBy(by, columns, compression, quantiles).update(chunk)
+
+
+def grouped_summary(source, by, columns, chunksize=100000, n_jobs=1,
+                    compression=200, quantiles=True, **read_csv_kwargs):
+    """`StreamingGroupBy` state of a CSV path, DataFrame or chunk iterable
+
+    With `n_jobs` > 1, chunks are summarized by a process pool (at most
+    two per worker in flight, so memory stays bounded) and the states
+    merged.
+    """
+    by_columns = [by] if isinstance(by, str) else list(by)
+    names = [columns] if isinstance(columns, str) else list(columns)
+    chunks = iter_chunks(source, by_columns + names, chunksize,
+                         **read_csv_kwargs)
+    state = StreamingGroupBy(by, columns, compression, quantiles)
+    n_jobs = n_jobs or os.cpu_count()
+    if n_jobs == 1:
+        for chunk in chunks:
+            state.update(chunk)
+        return state
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(_summarize, chunk, by, columns,
+                                       compression, quantiles))
+            if len(pending) >= 2 * n_jobs:
+                state.merge(pending.popleft().result())
+        for future in pending:
+            state.merge(future.result())
+    return state
+
+
+METHODS = ['Radial Velocity', 'Transit', 'Imaging', 'Microlensing',
+           'Eclipse Timing Variations', 'Pulsar Timing',
+           'Transit Timing Variations', 'Orbital Brightness Modulation',
+           'Astrometry', 'Pulsation Timing Variations']
+
+
+def make_synthetic_planets(n_rows, random_state=0):
+    """A frame shaped like seaborn's planets table (method, number,
+    orbital_period, mass, distance, year)"""
+    rng = np.random.default_rng(random_state)
+    share = np.array([553, 397, 38, 23, 9, 5, 4, 3, 2, 1], dtype=float)
+    method = rng.choice(len(METHODS), n_rows, p=share / share.sum())
+    period = np.exp(rng.normal(2 + method / 2, 2, n_rows))
+    period[rng.random(n_rows) < 0.04] = np.nan
+    return pd.DataFrame({
+        'method': np.array(METHODS, dtype=object)[method],
+        'number': rng.integers(1, 8, n_rows),
+        'orbital_period': period,
+        'mass': np.where(rng.random(n_rows) < 0.5, np.nan,
+                         rng.lognormal(0, 1, n_rows)),
+        'distance': rng.lognormal(4, 1, n_rows),
+        'year': rng.integers(1989, 2015, n_rows)})
+
+
+if __name__ == '__main__':
+    import sys
+    import tempfile
+    from time import perf_counter
+
+    planets = make_synthetic_planets(1035)
+    state = grouped_summary(planets, 'method', 'orbital_period', chunksize=100)
+    expected = planets.groupby('method')['orbital_period'].aggregate(
+        ['count', 'mean', 'std', 'min', 'median', 'max'])
+    result = state.aggregate()
+    # the t-digest median is exact for small groups, close for large ones
+    assert np.allclose(result, expected, rtol=1e-2, equal_nan=True)
+    assert np.allclose(result.drop(columns='median'),
+                       expected.drop(columns='median'), equal_nan=True)
+    halves = [grouped_summary(part, ['method', 'year'], ['mass', 'distance'])
+              for part in (planets[:500], planets[500:])]
+    merged = halves[0].merge(halves[1]).aggregate(['count', 'sum', 'max'])
+    expected = planets.groupby(['method', 'year'])[['mass', 'distance']] \
+        .aggregate(['count', 'sum', 'max'])
+    assert np.allclose(merged, expected, equal_nan=True)
+    # a large offset cancels catastrophically in sumsq - sum * mean
+    shifted = planets.assign(orbital_period=planets['orbital_period'] + 1e9)
+    variance = grouped_summary(shifted, 'method', 'orbital_period',
+                               chunksize=100).aggregate(['var'])['var']
+    expected = shifted.groupby('method')['orbital_period'].var()
+    assert np.allclose(variance, expected,
+                       rtol=1e-6, equal_nan=True)
+    print(state.aggregate(['count', 'min', 'median', 'max']))
+
+    n_rows = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10000000
+    path = os.path.join(tempfile.mkdtemp(), 'planets.csv')
+    t0 = perf_counter()
+    for start in range(0, n_rows, 1000000):
+        make_synthetic_planets(min(1000000, n_rows - start), start).to_csv(
+            path, mode='a', header=not start, index=False)
+    print('\nwrote %d rows (%.0f MB) in %.1fs'
+          % (n_rows, os.path.getsize(path) / 1e6, perf_counter() - t0))
+
+    t0 = perf_counter()
+    frame = pd.read_csv(path, usecols=['method', 'orbital_period'])
+    expected = frame.groupby('method')['orbital_period'].aggregate(
+        ['count', 'mean', 'std', 'min', 'median', 'max'])
+    t_pandas = perf_counter() - t0
+    del frame
+    for n_jobs in sorted({1, os.cpu_count()}):
+        t0 = perf_counter()
+        state = grouped_summary(path, 'method', 'orbital_period',
+                                chunksize=500000, n_jobs=n_jobs)
+        result = state.aggregate()
+        t_stream = perf_counter() - t0
+        assert np.array_equal(result['count'], expected['count'])
+        assert np.allclose(result.drop(columns='median'),
+                           expected.drop(columns='median'))
+        error = np.abs(result['median'] / expected['median'] - 1).max()
+        print('streaming, %d process(es): %.1fs (read_csv + groupby: %.1fs);'
+              ' largest relative median error %.1e'
+              % (n_jobs, t_stream, t_pandas, error))
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""Out-of-core version of the Lecture18_Script4 unsupervised pipeline
+
+Lecture18_Script4 reduces iris to two dimensions with `PCA(n_components=2)`
+and clusters it with `GaussianMixture(n_components=3)` and
+`KMeans(n_clusters=3)`, all on an in-memory frame.  The same three steps
+are done here on an `(n_samples, n_features)` array stored as a
+memory-mapped `.npy` file, reading it one block at a time:
+
+* `IncrementalPCA.partial_fit` for the projection,
+* `MiniBatchKMeans.partial_fit` for k-means,
+* `MiniBatchGaussianMixture`, a stepwise (online) EM mixture model with full
+  covariances, since Scikit-Learn's `GaussianMixture` has no `partial_fit`.
+
+The first pass fits all three models from the same blocks; the second pass
+writes the 2-D projection and both sets of cluster labels to memory-mapped
+outputs.  Peak memory depends on the block size, not the file size.
+
+Running the module benchmarks the pipeline on synthetic iris-like data:
+
+    python streaming_unsupervised.py              # up to 10M rows
+    python streaming_unsupervised.py 50000000     # up to 50M rows
+"""
+
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+import numpy as np
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.decomposition import IncrementalPCA
+
+# per-species feature means and standard deviations of the iris data set
+# (sepal_length, sepal_width, petal_length, petal_width)
+IRIS_MEANS = np.array([[5.006, 3.428, 1.462, 0.246],
+                       [5.936, 2.770, 4.260, 1.326],
+                       [6.588, 2.974, 5.552, 2.026]])
+IRIS_STDS = np.array([[0.352, 0.379, 0.174, 0.105],
+                      [0.516, 0.314, 0.470, 0.198],
+                      [0.636, 0.322, 0.552, 0.275]])
+
+
+def make_synthetic_iris(path, n_samples, block_size=1000000, dtype='float32',
+                        random_state=0):
+    """Write an iris-like `.npy` file of `n_samples` rows, block by block
+
+    Returns a read-only memory map of the file.  The species labels are
+    not kept, this is an unsupervised benchmark.
+    """
+    rng = np.random.RandomState(random_state)
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                    shape=(n_samples, IRIS_MEANS.shape[1]))
+    for start in range(0, n_samples, block_size):
+        stop = min(start + block_size, n_samples)
+        species = rng.randint(0, 3, stop - start)
+        out[start:stop] = (IRIS_MEANS[species] + IRIS_STDS[species]
+                           * rng.randn(stop - start, IRIS_MEANS.shape[1]))
+    out.flush()
+    del out
+    return np.load(path, mmap_mode='r')
+
+
+def iter_blocks(X, block_size, min_size=1):
+    """Yield ``(start, stop)`` bounds covering X in blocks
+
+    A trailing block shorter than `min_size` is merged into the one before
+    it, so every block is large enough for the estimators' first call.
+    """
+    n_samples = len(X)
+    starts = list(range(0, n_samples, block_size))
+    if len(starts) > 1 and n_samples - starts[-1] < min_size:
+        starts.pop()
+    for i, start in enumerate(starts):
+        stop = starts[i + 1] if i + 1 < len(starts) else n_samples
+        yield start, stop
+
+
+class MiniBatchGaussianMixture:
+    """Full-covariance Gaussian mixture fit by stepwise EM on mini-batches
+
+    Each call to `partial_fit` runs an E-step on the batch and blends the
+    batch's normalized sufficient statistics into the running ones with
+    step size ``(t + 2) ** -decay`` before an M-step.
+    """
+
+    def __init__(self, n_components=3, reg_covar=1e-6, decay=0.6,
+                 random_state=None):
+        self.n_components = n_components
+        self.reg_covar = reg_covar
+        self.decay = decay
+        self.random_state = random_state
+
+    def _initialize(self, X):
+        labels = KMeans(self.n_components, n_init=1,
+                        random_state=self.random_state).fit_predict(X)
+        resp = np.eye(self.n_components)[labels]
+        self.n_steps_ = 0
+        self._update(*self._batch_stats(X, resp), rho=1.0)
+
+    @staticmethod
+    def _batch_stats(X, resp):
+        n = len(X)
+        s0 = resp.sum(axis=0) / n
+        s1 = resp.T @ X / n
+        s2 = np.stack([(resp[:, k, None] * X).T @ X / n
+                       for k in range(resp.shape[1])])
+        return s0, s1, s2
+
+    def _update(self, s0, s1, s2, rho):
+        if rho == 1.0:
+            self._s0, self._s1, self._s2 = s0, s1, s2
+        else:
+            self._s0 = (1 - rho) * self._s0 + rho * s0
+            self._s1 = (1 - rho) * self._s1 + rho * s1
+            self._s2 = (1 - rho) * self._s2 + rho * s2
+
+        s0 = np.maximum(self._s0, 10 * np.finfo(float).eps)
+        self.weights_ = s0 / s0.sum()
+        self.means_ = self._s1 / s0[:, None]
+        mu = self.means_
+        self.covariances_ = (self._s2 / s0[:, None, None]
+                             - mu[:, :, None] * mu[:, None, :]
+                             + self.reg_covar * np.eye(mu.shape[1]))
+
+    def _log_prob(self, X):
+        n, d = X.shape
+        log_prob = np.empty((n, self.n_components))
+        for k in range(self.n_components):
+            L = np.linalg.cholesky(self.covariances_[k])
+            z = np.linalg.solve(L, (X - self.means_[k]).T)
+            log_det = 2 * np.log(np.diag(L)).sum()
+            log_prob[:, k] = -0.5 * (d * np.log(2 * np.pi) + log_det
+                                     + (z ** 2).sum(axis=0))
+        return log_prob + np.log(self.weights_)
+
+    def _log_resp(self, X):
+        weighted = self._log_prob(X)
+        norm = np.logaddexp.reduce(weighted, axis=1)
+        return weighted - norm[:, None], norm
+
+    def partial_fit(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        if not hasattr(self, 'means_'):
+            self._initialize(X)
+            return self
+        resp = np.exp(self._log_resp(X)[0])
+        self.n_steps_ += 1
+        rho = (self.n_steps_ + 1) ** -self.decay
+        self._update(*self._batch_stats(X, resp), rho=rho)
+        return self
+
+    def predict_proba(self, X):
+        return np.exp(self._log_resp(np.asarray(X, dtype=np.float64))[0])
+
+    def predict(self, X):
+        return self._log_prob(np.asarray(X, dtype=np.float64)).argmax(axis=1)
+
+    def score(self, X):
+        """Mean log-likelihood per sample"""
+        return self._log_resp(np.asarray(X, dtype=np.float64))[1].mean()
+
+
+def fit_pipeline(X, block_size=100000, n_components=2, n_clusters=3,
+                 n_epochs=1, out_dir=None, random_state=0):
+    """Fit PCA, GMM and KMeans on X block by block, then label every row
+
+    X may be any array-like supporting slicing, typically the result of
+    ``np.load(path, mmap_mode='r')``.  Outputs are written to memory-mapped
+    files in `out_dir` (a temporary directory by default) and returned as a
+    dict next to the fitted models.
+    """
+    min_size = max(n_components, n_clusters)
+    pca = IncrementalPCA(n_components=n_components)
+    gmm = MiniBatchGaussianMixture(n_clusters, random_state=random_state)
+    kmeans = MiniBatchKMeans(n_clusters, random_state=random_state,
+                             n_init=3)
+
+    # pass 1: fit all three models from the same blocks
+    for _ in range(n_epochs):
+        for start, stop in iter_blocks(X, block_size, min_size):
+            block = np.asarray(X[start:stop], dtype=np.float64)
+            pca.partial_fit(block)
+            gmm.partial_fit(block)
+            kmeans.partial_fit(block)
+
+    # pass 2: project and label
+    out_dir = out_dir or tempfile.mkdtemp()
+    n_samples = len(X)
+    X_2D = np.lib.format.open_memmap(os.path.join(out_dir, 'X_2D.npy'), 'w+',
+                                     np.float64, (n_samples, n_components))
+    y_gmm = np.lib.format.open_memmap(os.path.join(out_dir, 'y_gmm.npy'),
+                                      'w+', np.int8, (n_samples,))
+    y_kmeans = np.lib.format.open_memmap(
+        os.path.join(out_dir, 'y_kmeans.npy'), 'w+', np.int8, (n_samples,))
+    for start, stop in iter_blocks(X, block_size):
+        block = np.asarray(X[start:stop], dtype=np.float64)
+        X_2D[start:stop] = pca.transform(block)
+        y_gmm[start:stop] = gmm.predict(block)
+        y_kmeans[start:stop] = kmeans.predict(block)
+
+    outputs = {'X_2D': X_2D, 'y_gmm': y_gmm, 'y_kmeans': y_kmeans}
+    return pca, gmm, kmeans, outputs
+
+
+def benchmark(sizes, block_size=1000000, work_dir=None):
+    """Time data generation and the two pipeline passes for each size"""
+    work_dir = work_dir or tempfile.mkdtemp()
+    print('%12s %10s %10s %12s' % ('rows', 'write (s)', 'fit (s)',
+                                   'rows/s'))
+    for n in sizes:
+        path = os.path.join(work_dir, 'iris_%d.npy' % n)
+        t0 = perf_counter()
+        X = make_synthetic_iris(path, n, block_size)
+        t1 = perf_counter()
+        _, _, _, outputs = fit_pipeline(X, block_size=min(block_size, n),
+                                        out_dir=work_dir)
+        t2 = perf_counter()
+        print('%12d %10.2f %10.2f %12.0f' % (n, t1 - t0, t2 - t1,
+                                             n / (t2 - t1)))
+        del X, outputs
+        for name in ('iris_%d.npy' % n, 'X_2D.npy', 'y_gmm.npy',
+                     'y_kmeans.npy'):
+            os.remove(os.path.join(work_dir, name))
+
+
+if __name__ == '__main__':
+    largest = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10000000
+    sizes = [n for n in (150, 10000, 1000000, 10000000, 50000000)
+             if n < largest] + [largest]
+    benchmark(sizes)